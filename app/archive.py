@@ -0,0 +1,132 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import tempfile
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator, Optional
+
+import metrics
+from settings import ARCHIVE_DIR
+
+# raw vk responses are stored gzipped under the sha256 of their content:
+#   objects/ab/ab12...gz            one file per distinct response
+#   refs/<endpoint>/<key>           the digest a request returned
+
+
+class Recorder:
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        # wbits=31 writes a gzip container, the objects open with gzip.open
+        self._zip = zlib.compressobj(wbits=31)
+        # compressed chunks go to a temporary file next to the objects,
+        # it is renamed once the digest is known
+        self._file = None
+
+    async def feed(self, chunk: bytes) -> None:
+        # hashing, compression and writes run off the event loop
+        await asyncio.to_thread(self._write, chunk)
+
+    async def save(self, ref: str) -> str:
+        with metrics.timer('archive_write'):
+            return await asyncio.to_thread(self._save, ref)
+
+    def discard(self) -> None:
+        # a response cut short leaves no temporary file behind
+        if self._file is not None:
+            self._file.close()
+            os.unlink(self._file.name)
+            self._file = None
+
+    def _open(self) -> None:
+        if self._file is None:
+            root = Path(ARCHIVE_DIR, 'objects')
+            root.mkdir(parents=True, exist_ok=True)
+            self._file = tempfile.NamedTemporaryFile(dir=root, prefix='.',
+                                                     delete=False)
+
+    def _write(self, chunk: bytes) -> None:
+        self._open()
+        self._hash.update(chunk)
+        self._file.write(self._zip.compress(chunk))
+
+    def _save(self, ref: str) -> str:
+        self._open()
+        self._file.write(self._zip.flush())
+        self._file.close()
+        digest = self._hash.hexdigest()
+
+        path = object_path(digest)
+        path.parent.mkdir(exist_ok=True)
+        if path.exists():
+            os.unlink(self._file.name)
+        else:
+            os.replace(self._file.name, path)
+        self._file = None
+
+        ref_path = Path(ARCHIVE_DIR, 'refs', ref)
+        previous = ref_path.read_text() if ref_path.exists() else digest
+        write_atomic(ref_path, digest.encode())
+        if previous != digest:
+            release(previous, ref)
+
+        return digest
+
+
+def recorder() -> Optional[Recorder]:
+    return Recorder() if ARCHIVE_DIR else None
+
+
+async def store(ref: str, content: bytes) -> None:
+    if ARCHIVE_DIR:
+        record = Recorder()
+        await record.feed(content)
+        await record.save(ref)
+
+
+def release(digest: str, ref: str) -> None:
+    # an overwritten ref drops its object unless another ref of the same
+    # endpoint still points to it, endpoints never share responses
+    endpoint = Path(ARCHIVE_DIR, 'refs', Path(ref).parts[0])
+    for path in endpoint.rglob('*'):
+        if (path.is_file() and not path.name.startswith('.')
+                and path.read_text() == digest):
+            return
+    object_path(digest).unlink(missing_ok=True)
+
+
+def object_path(digest: str) -> Path:
+    return Path(ARCHIVE_DIR, 'objects', digest[:2], f'{digest}.gz')
+
+
+def write_atomic(path: Path, content: bytes) -> None:
+    # concurrent chunks may store the same object, readers never see a
+    # half written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.{id(content)}')
+    tmp.write_bytes(content)
+    os.replace(tmp, path)
+
+
+def refs(endpoint: str) -> list[str]:
+    # oldest first, replaying in this order lets newer data win
+    root = Path(ARCHIVE_DIR, 'refs')
+    paths = [path for path in (root / endpoint).rglob('*')
+             if path.is_file() and not path.name.startswith('.')]
+    return [str(path.relative_to(root)) for path in
+            sorted(paths, key=lambda path: path.stat().st_mtime)]
+
+
+def saved_at(ref: str) -> datetime:
+    path = Path(ARCHIVE_DIR, 'refs', ref)
+    return datetime.fromtimestamp(path.stat().st_mtime)
+
+
+def read_lines(ref: str) -> Iterator[bytes]:
+    digest = Path(ARCHIVE_DIR, 'refs', ref).read_text()
+    with gzip.open(object_path(digest)) as file:
+        for line in file:
+            yield line.rstrip(b'\n')
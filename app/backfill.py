@@ -0,0 +1,91 @@
+import asyncio
+from collections import deque
+from datetime import date, datetime
+from typing import Optional
+
+from db.models import BackfillChunkModel
+from db.session import SessionLocal
+from parsers import SessionExpired, fetch_stats, get_cookies, renew_cookies
+from settings import BACKFILL_WORKERS, START_YEAR
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from utils import ensure_stats_partitions, write_to_db
+
+# (month, day)
+CHUNKS = (((1, 1), (3, 31)), ((4, 1), (6, 30)),
+          ((7, 1), (9, 30)), ((10, 1), (12, 31)))
+
+
+def get_chunks(start_year: int = START_YEAR,
+               end_year: Optional[int] = None) -> list[tuple[date, date]]:
+    end_year = end_year or date.today().year
+    return [(date(year, *start), date(year, *end))
+            for year in range(start_year, end_year + 1)
+            for start, end in CHUNKS]
+
+
+async def load_chunk(db: AsyncSession, cookies: dict, hash_curl: str,
+                     start_date: date, end_date: date) -> int:
+    # the quarter is streamed from vk into the database and committed
+    # with its checkpoint
+    groups = {}
+    rows = await write_to_db(
+        db=db, stats=fetch_stats(cookies, hash_curl, start_date, end_date,
+                                 groups),
+        groups=groups, commit=False)
+    db.add(BackfillChunkModel(start_date=start_date, end_date=end_date,
+                              rows=rows, loaded_at=datetime.now()))
+    await db.commit()
+    return rows
+
+
+async def load_history(db: AsyncSession, workers: int = BACKFILL_WORKERS
+                       ) -> Optional[int]:
+    done = set(await db.scalars(select(BackfillChunkModel.start_date)))
+    chunks = deque(chunk for chunk in get_chunks() if chunk[0] not in done)
+    total, loaded, rows = len(chunks), 0, 0
+
+    credentials = await get_cookies(db)
+    # workers write concurrently, each year's partition is there before
+    # any of them needs it
+    await ensure_stats_partitions(db, [start for start, _ in chunks])
+    await db.commit()
+
+    async def worker() -> None:
+        nonlocal credentials, loaded, rows
+        while chunks:
+            start_date, end_date = chunks.popleft()
+            async with SessionLocal() as chunk_db:
+                used = credentials
+                try:
+                    written = await load_chunk(chunk_db, *used, start_date,
+                                               end_date)
+                except SessionExpired:
+                    # the quarter is tried once more if other cookies
+                    # were stored since the load started
+                    await chunk_db.rollback()
+                    if credentials == used:
+                        renewed = await renew_cookies(chunk_db, used)
+                        if renewed is None:
+                            raise
+                        credentials = renewed
+                    written = await load_chunk(chunk_db, *credentials,
+                                               start_date, end_date)
+            rows += written
+            loaded += 1
+            print(f'{start_date} - {end_date} processed ({loaded}/{total})')
+
+    # every worker holds one quarter at a time and only while streaming
+    # it, any of them failing (e.g. with an expired session) ends the load
+    tasks = [asyncio.create_task(worker())
+             for _ in range(min(workers, len(chunks)))]
+    try:
+        await asyncio.gather(*tasks)
+    except SessionExpired:
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    return rows
@@ -0,0 +1,83 @@
+import random
+from datetime import date, timedelta
+
+SELECTION_ROW = (
+    '<tr><td><a href=\\"\\/club{idx}\\" '
+    'class=\\"exchange_comm_name\\">{name}<\\/a><\\/td>'
+    '<td nowrap>{reach_post} \\/ {reach_daily} человек<\\/td>'
+    '<td><b>{price}<\\/b> руб.<\\/td>'
+    '<td><a id=\\"stats-{idx}\\" onclick=\\"return false;\\">stats<\\/a>'
+    '<\\/td><\\/tr>'
+)
+
+EXPORT_HEADER = ('Дата;Объявление;Формат;Тематика;Ссылка;Пост;Площадка;'
+                 'Сообщество;ID;Подписчики;Охват за сутки;Потрачено;'
+                 'Переходы;Вступления;Охват;Охват подписчиков;'
+                 'Лайки;Репосты;Комментарии')
+EXPORT_ROW = ('{date};{ad};post;theme;link;post {post};community;'
+              'Сообщество {idx};{idx};{followers};{reach_daily};{cost};'
+              '{clicks};{new_follows};{reach_all};{reach_followers};'
+              '{likes};{shares};{comments}')
+
+# the overview regexes look up to 200 characters ahead, a real page has
+# at least that much markup between two placements
+OVERVIEW_PADDING = ' ' * 250
+OVERVIEW_ACTIVE = ('"group_link\\" >Сообщество {idx}<\\/a> Цена: '
+                   '<b>{price}<\\/b> руб. stats-{idx} '
+                   'Опубликована:<\\/span>вчера')
+OVERVIEW_PENDING = ('"group_link\\" >Сообщество {idx}<\\/a> Цена: '
+                    '<b>{price}<\\/b> руб. deleteRequest({idx} '
+                    'Будет опубликована:<\\/span><br>{day} янв 2030 в ')
+
+
+def spaced(value: int) -> str:
+    return f'{value:,}'.replace(',', ' ')
+
+
+def make_group_ids(groups: int = 500, seed: int = 0) -> list[int]:
+    return random.Random(seed).sample(range(1, 200_000_000), groups)
+
+
+def make_selection(groups: int = 500, seed: int = 0,
+                   ids: list[int] = None) -> str:
+    rnd = random.Random(seed)
+    ids = ids or [rnd.randrange(1, 200_000_000) for _ in range(groups)]
+    rows = [SELECTION_ROW.format(
+        idx=idx,
+        name=f'Сообщество {i}',
+        reach_post=spaced(rnd.randrange(1_000, 500_000)),
+        reach_daily=spaced(rnd.randrange(1_000, 2_000_000)),
+        price=spaced(rnd.randrange(100, 30_000)),
+    ) for i, idx in enumerate(ids[:groups])]
+    return '<!--{"payload":[0,["' + ''.join(rows) + '"]]}'
+
+
+def make_export(start: date, end: date, ids: list[int],
+                per_day: int = 10, seed: int = 0) -> bytes:
+    # a cp1251 get_export_stats body, (date, group, post) stays unique
+    rnd = random.Random(f'{seed} {start}')
+    rows = [EXPORT_HEADER]
+    day = start
+    while day <= min(end, date.today()):
+        for idx in rnd.sample(ids, min(per_day, len(ids))):
+            rows.append(EXPORT_ROW.format(
+                date=day, ad=rnd.randrange(1_000_000), post=rnd.randrange(40),
+                idx=idx, followers=rnd.randrange(100_000),
+                reach_daily=rnd.randrange(10_000),
+                cost=rnd.randrange(50, 5_000), clicks=rnd.randrange(100),
+                new_follows=rnd.randrange(50),
+                reach_all=rnd.randrange(20_000),
+                reach_followers=rnd.randrange(10_000),
+                likes=rnd.randrange(100), shares=rnd.randrange(20),
+                comments=rnd.randrange(20)))
+        day += timedelta(days=1)
+    rows.append('Всего;;;')
+    return '\n'.join(rows).encode('cp1251')
+
+
+def make_overview(status: str, ids: list[int], seed: int = 0) -> str:
+    rnd = random.Random(f'{seed} {status}')
+    row = OVERVIEW_ACTIVE if status == '3' else OVERVIEW_PENDING
+    return '<!--{"payload":[0,["' + OVERVIEW_PADDING.join(row.format(
+        idx=idx, price=rnd.randrange(100, 30_000), day=rnd.randrange(1, 29))
+        for idx in ids) + '"]]}'
@@ -0,0 +1,49 @@
+"""get_selection parsing time on a synthetic large community_search page.
+
+    python -m benchmarks.selection_parser
+"""
+import os
+import re
+import timeit
+
+from benchmarks.fixtures import make_selection
+from parsers import extract_digits, parse_selection
+
+GROUPS = int(os.environ.get('BENCH_GROUPS', 2_000))
+REPEAT = int(os.environ.get('BENCH_REPEAT', 20))
+
+
+def legacy_parse_selection(response: str) -> dict:
+    re_patterns = {
+        'group_name': r'exchange_comm_name\\".{,50}',
+        'group_idx': r'stats-\d+',
+        'prices': r'человек<\\/td>.{,200}<\\/b> руб.',
+        'reach_post': r'nowrap.{,200} \\/ ',
+        'reach_daily': r' \\/ .{,200}человек',
+    }
+
+    group_name = [i[21:i.find('<\\/a>')] for i in re.findall(
+        re_patterns['group_name'], response)]
+
+    group_idx = extract_digits(re_patterns['group_idx'], response)
+    prices = extract_digits(re_patterns['prices'], response)
+    reach_post = extract_digits(re_patterns['reach_post'], response)
+    reach_daily = extract_digits(re_patterns['reach_daily'], response)
+
+    return {i: (n, p, cp, cd) for i, n, p, cp, cd in zip(
+        group_idx, group_name, prices, reach_post, reach_daily)}
+
+
+def main() -> None:
+    response = make_selection(GROUPS)
+    assert parse_selection(response) == legacy_parse_selection(response)
+
+    for name, parser in (('five findall scans', legacy_parse_selection),
+                         ('row by row', parse_selection)):
+        seconds = min(timeit.repeat(
+            lambda: parser(response), number=1, repeat=REPEAT))
+        print(f'{name:<20} {GROUPS:>6} groups  {seconds * 1000:>8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
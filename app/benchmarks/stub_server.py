@@ -0,0 +1,96 @@
+"""Local stand-in for vk.com/adsmarket.
+
+Answers get_export_stats, overview and community_search with synthetic
+pages, or with recorded ones when BENCH_FIXTURES points at a directory of
+anonymized responses (get_export_stats.csv, overview_1.html,
+overview_3.html, community_search.html):
+
+    python -m benchmarks.stub_server 8001
+    VK_URL=http://127.0.0.1:8001/adsmarket uvicorn main:app
+"""
+import os
+import sys
+import threading
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+from urllib.parse import parse_qsl, urlsplit
+
+from benchmarks.fixtures import (make_export, make_group_ids, make_overview,
+                                 make_selection)
+
+FIXTURES = os.environ.get('BENCH_FIXTURES')
+GROUPS = int(os.environ.get('BENCH_GROUPS', 2_000))
+PER_DAY = int(os.environ.get('BENCH_PER_DAY', 10))
+ACTIVE_GROUPS = int(os.environ.get('BENCH_ACTIVE_GROUPS', 50))
+
+GROUP_IDS = make_group_ids(GROUPS)
+
+
+@lru_cache(maxsize=None)
+def export(start_time: str, end_time: str) -> bytes:
+    return make_export(datetime.strptime(start_time, '%Y%m%d').date(),
+                       datetime.strptime(end_time, '%Y%m%d').date(),
+                       GROUP_IDS, PER_DAY)
+
+
+@lru_cache(maxsize=None)
+def recorded(name: str) -> Optional[bytes]:
+    path = Path(FIXTURES or '') / name
+    return path.read_bytes() if FIXTURES and path.is_file() else None
+
+
+def respond(act: str, form: dict) -> Optional[bytes]:
+    if act == 'get_export_stats':
+        return (recorded('get_export_stats.csv')
+                or export(form['start_time'], form['end_time']))
+    if act == 'overview':
+        return (recorded(f'overview_{form["status"]}.html')
+                or make_overview(form['status'],
+                                 GROUP_IDS[:ACTIVE_GROUPS]).encode())
+    if act == 'community_search':
+        return (recorded('community_search.html')
+                or make_selection(GROUPS, ids=GROUP_IDS).encode())
+    return None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, with nagle on every
+    # keep-alive response would wait for the client's delayed ack
+    disable_nagle_algorithm = True
+
+    def do_POST(self) -> None:
+        act = dict(parse_qsl(urlsplit(self.path).query)).get('act')
+        length = int(self.headers.get('Content-Length', 0))
+        form = dict(parse_qsl(self.rfile.read(length).decode()))
+
+        body = respond(act, form)
+        if body is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        charset = 'windows-1251' if act == 'get_export_stats' else 'utf-8'
+        self.send_header('Content-Type', f'text/html; charset={charset}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def start(port: int = 0) -> (ThreadingHTTPServer, str):
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/adsmarket'
+
+
+if __name__ == '__main__':
+    server, url = start(int(sys.argv[1]) if len(sys.argv) > 1 else 8001)
+    print(f'serving {url}')
+    threading.Event().wait()
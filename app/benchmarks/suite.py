@@ -0,0 +1,212 @@
+"""Throughput and latency of the parsers, the write path and every endpoint.
+
+vk is replaced by benchmarks.stub_server and everything is written to a
+throwaway database, every table in it is dropped:
+
+    BENCH_DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.suite
+"""
+import asyncio
+import math
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from datetime import date
+from typing import Awaitable, Callable
+from unittest.mock import patch
+
+from benchmarks import stub_server
+
+# settings are read on import, the app has to see the stub and the
+# throwaway database before any of its modules is loaded
+server, vk_url = stub_server.start()
+os.environ['VK_URL'] = vk_url
+os.environ['DATABASE_URL'] = os.environ['BENCH_DATABASE_URL']
+os.environ['REFRESH_INTERVAL'] = '0'
+os.environ['ARCHIVE_DIR'] = archive_dir = tempfile.mkdtemp()
+os.environ['STATS_CACHE_DIR'] = stats_cache_dir = tempfile.mkdtemp()
+
+import columnar  # noqa: E402
+import httpx  # noqa: E402
+import main  # noqa: E402
+import watermarks  # noqa: E402
+from benchmarks.fixtures import make_export, make_selection  # noqa: E402
+from db.models import Base, StatsModel  # noqa: E402
+from db.session import SessionLocal, engine  # noqa: E402
+from parsers import (fetch_stats, get_active, get_cookies,  # noqa: E402
+                     get_selection, iter_stats, parse_selection,
+                     selection_cache)
+from replay import replay  # noqa: E402
+from scoring import score_selection  # noqa: E402
+from sqlalchemy import func, select  # noqa: E402
+from utils import get_context, write_to_db  # noqa: E402
+
+REPEAT = int(os.environ.get('BENCH_REPEAT', 20))
+SELECTION_URL = 'https://vk.com/adsmarket?act=community_search&ad_id=1&f=1'
+CURL = ("curl 'https://vk.com/adsmarket' "
+        "-H 'cookie: remixsid=bench; remixnsid=bench;' --data 'hash=bench'")
+
+
+def report(name: str, samples: list[float], items: int = 0,
+           unit: str = 'rows') -> None:
+    p50 = statistics.median(samples)
+    p95 = sorted(samples)[math.ceil(len(samples) * 0.95) - 1]
+    rate = f'{items / p50:>10.0f} {unit}/s' if items else ''
+    print(f'{name:<34} n={len(samples):<3} p50 {p50 * 1000:>9.2f} ms  '
+          f'p95 {p95 * 1000:>9.2f} ms  {rate}')
+
+
+async def measure(call: Callable[[], Awaitable], repeat: int = REPEAT,
+                  before: Callable[[], None] = None) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        if before:
+            before()
+        started = time.perf_counter()
+        await call()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def measure_sync(call: Callable, repeat: int = REPEAT) -> list[float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def reset_db() -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+
+def bench_parsers() -> None:
+    lines = make_export(date(2022, 1, 1), date(2022, 12, 31),
+                        stub_server.GROUP_IDS,
+                        stub_server.PER_DAY).split(b'\n')[1:]
+    rows = len(list(iter_stats(lines, {})))
+    report('parse stats export', measure_sync(
+        lambda: list(iter_stats(lines, {})), 5), rows)
+
+    response = make_selection(stub_server.GROUPS,
+                              ids=stub_server.GROUP_IDS)
+    report('parse selection', measure_sync(
+        lambda: parse_selection(response)), stub_server.GROUPS, 'groups')
+
+
+async def collect_stats(cookies: dict, hash_curl: str, start: date,
+                        end: date) -> (list, dict):
+    groups = {}
+    stats = [row async for row in fetch_stats(cookies, hash_curl, start, end,
+                                              groups)]
+    return stats, groups
+
+
+async def bench_vk_calls(cookies: dict, hash_curl: str) -> None:
+    start, end = date(2022, 1, 1), date(2022, 3, 31)
+    stats, _ = await collect_stats(cookies, hash_curl, start, end)
+    report('fetch_stats (quarter)', await measure(
+        lambda: collect_stats(cookies, hash_curl, start, end), 5),
+        len(stats))
+
+    report('get_selection (uncached)', await measure(
+        lambda: get_selection(cookies, SELECTION_URL),
+        before=selection_cache.clear), stub_server.GROUPS, 'groups')
+    report('get_selection (cached)', await measure(
+        lambda: get_selection(cookies, SELECTION_URL)))
+
+    report('get_active', await measure(lambda: get_active(cookies, '3')))
+
+
+async def bench_db(cookies: dict, hash_curl: str) -> None:
+    stats, groups = await collect_stats(cookies, hash_curl,
+                                        date(2021, 1, 1), date(2021, 12, 31))
+
+    async with SessionLocal() as db:
+        report('write_to_db (new rows)', await measure(
+            lambda: write_to_db(db, stats, groups), 1), len(stats))
+        # a refresh mostly rewrites rows that did not change
+        report('write_to_db (unchanged rows)', await measure(
+            lambda: write_to_db(db, stats, groups), 3), len(stats))
+
+        selection = await get_selection(cookies, SELECTION_URL)
+        report('get_context', await measure(
+            lambda: get_context(db, selection)), len(selection), 'groups')
+
+        report('columnar refresh', await measure(
+            lambda: columnar.refresh(db), 3), len(stats))
+        report('columnar group_kpis', measure_sync(
+            lambda: columnar.group_kpis(selection)), len(selection),
+            'groups')
+        report('score_selection', measure_sync(
+            lambda: score_selection(selection)), len(selection), 'groups')
+
+
+async def bench_endpoints(client: httpx.AsyncClient) -> None:
+    async def post(path: str, **data) -> None:
+        (await client.post(path, data=data)).raise_for_status()
+
+    async def get(path: str) -> None:
+        (await client.get(path)).raise_for_status()
+
+    await reset_db()
+    await post('/update_cookies', curl=CURL)
+
+    samples = await measure(lambda: post('/load_stats'), 1)
+    async with SessionLocal() as db:
+        rows = await db.scalar(select(func.count()).select_from(StatsModel))
+    report('POST /load_stats', samples, rows)
+
+    # the same history again, from the archive /load_stats just filled
+    async with SessionLocal() as db:
+        report('replay archive', await measure(lambda: replay(db), 1), rows)
+
+    # right after a load the export is fresh and skipped, a stale one is
+    # fetched again from its last day
+    report('POST /update_stats (fresh)', await measure(
+        lambda: post('/update_stats'), 5))
+    with patch.object(watermarks, 'STATS_MAX_AGE', -1):
+        report('POST /update_stats (stale)', await measure(
+            lambda: post('/update_stats'), 5))
+    report('POST /analyze', await measure(
+        lambda: post('/analyze', url=SELECTION_URL)))
+    report('POST /analyze?stream=true', await measure(
+        lambda: post('/analyze?stream=true', url=SELECTION_URL)))
+    report('POST /api/analyze', await measure(
+        lambda: post('/api/analyze', url=SELECTION_URL)))
+    report('GET /pending', await measure(lambda: get('/pending')))
+    report('POST /performance', await measure(
+        lambda: post('/performance', start='010121')))
+
+
+async def run() -> None:
+    transport = httpx.ASGITransport(app=main.app)
+    client = httpx.AsyncClient(transport=transport, base_url='http://bench',
+                               timeout=None)
+    try:
+        bench_parsers()
+
+        await reset_db()
+        await client.post('/update_cookies', data={'curl': CURL})
+        async with SessionLocal() as db:
+            cookies, hash_curl = await get_cookies(db)
+
+        await bench_vk_calls(cookies, hash_curl)
+        await bench_db(cookies, hash_curl)
+        await bench_endpoints(client)
+    finally:
+        await client.aclose()
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await engine.dispose()
+        server.shutdown()
+        shutil.rmtree(archive_dir)
+        shutil.rmtree(stats_cache_dir)
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
@@ -0,0 +1,88 @@
+"""Rows/second of the stats write path, ORM unit of work vs COPY.
+
+Runs against a throwaway database, every table in it is dropped:
+
+    BENCH_DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.write_path
+"""
+import asyncio
+import os
+import random
+import time
+from datetime import date, timedelta
+
+from db.models import Base, GroupModel, StatsModel
+from db.schemas import StatsRow
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from utils import ensure_stats_partitions, write_to_db
+
+# roughly what /load_stats writes for ten years of history
+ROWS = int(os.environ.get('BENCH_ROWS', 50_000))
+GROUPS = int(os.environ.get('BENCH_GROUPS', 2_000))
+
+
+def make_backfill(rows: int = ROWS,
+                  groups: int = GROUPS) -> (list[StatsRow], dict):
+    rnd = random.Random(0)
+    start = date(2015, 1, 1)
+    group_names = {i: f'group {i}' for i in range(1, groups + 1)}
+    # (date, group_id, post_name) stays unique while a day has fewer
+    # placements than there are groups
+    per_day = max(rows // 3650, 1)
+    stats = [StatsRow(
+        start + timedelta(days=i // per_day), f'post {rnd.randrange(40)}',
+        1 + i % groups, rnd.randrange(100_000), rnd.randrange(10_000),
+        rnd.randrange(50, 5_000), rnd.randrange(100), rnd.randrange(50),
+        rnd.randrange(20_000), rnd.randrange(10_000), rnd.randrange(100),
+        rnd.randrange(20), rnd.randrange(20),
+    ) for i in range(rows)]
+    return stats, group_names
+
+
+async def legacy_write(db: AsyncSession, stats: list[StatsRow],
+                       groups: dict) -> int:
+    for i, n in groups.items():
+        await db.merge(GroupModel(id=i, name=n))
+    await db.flush()
+    await ensure_stats_partitions(db, {row.date for row in stats})
+    db.add_all([StatsModel(**row._asdict()) for row in stats])
+    await db.commit()
+    return len(stats)
+
+
+async def bulk_write(db: AsyncSession, stats: list[StatsRow],
+                     groups: dict) -> int:
+    return await write_to_db(db, stats, groups)
+
+
+async def run(engine, writer, stats: list[StatsRow], groups: dict) -> float:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession(engine) as db:
+        started = time.perf_counter()
+        rows = await writer(db, stats, groups)
+        elapsed = time.perf_counter() - started
+        assert await db.scalar(text('SELECT count(*) FROM stats')) == rows
+    return rows / elapsed
+
+
+async def main() -> None:
+    engine = create_async_engine(os.environ['BENCH_DATABASE_URL'])
+    stats, groups = make_backfill()
+    writers = {
+        'orm merge + add_all': legacy_write,
+        'copy + staged upsert': bulk_write,
+    }
+    try:
+        for name, writer in writers.items():
+            rate = await run(engine, writer, stats, groups)
+            print(f'{name:<28} {len(stats):>8} rows  {rate:>10.0f} rows/s')
+    finally:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,213 @@
+import asyncio
+import json
+import math
+import os
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Iterable, Optional
+
+import metrics
+from db.models import StatsModel
+from settings import SCORE_HALF_LIFE, STATS_CACHE_DIR, TREND_DAYS
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# stats rows sorted by (group_id, date), one .npy file per column, so the
+# history of a group is a contiguous slice starting at starts[i]
+COLUMNS = ('group_id', 'date', 'cost', 'clicks', 'new_follows', 'reach_all')
+# per group totals, computed once per refresh
+TOTALS = ('cost', 'clicks', 'new_follows', 'reach_all')
+MANIFEST = 'manifest.json'
+# advisory lock key, one worker at a time writes a new version
+CACHE_LOCK = 20230520
+# every column as a 4 byte integer, binary COPY needs them non null
+QUERY = (f'SELECT group_id, date, '
+         f'{", ".join(f"COALESCE({name}, 0)" for name in COLUMNS[2:])} '
+         f'FROM {StatsModel.__tablename__} WHERE group_id IS NOT NULL '
+         f'ORDER BY group_id, date')
+# bumped whenever the set of stored columns changes, an older cache is
+# treated as missing and rebuilt at startup
+FORMAT = 2
+
+_snapshot = {'version': None, 'columns': None}
+
+
+def enabled() -> bool:
+    return bool(STATS_CACHE_DIR) and np is not None
+
+
+async def refresh(db: AsyncSession, missing_only: bool = False) -> None:
+    if not enabled():
+        return
+
+    # workers starting together would write versions over each other and
+    # remove each other's files, the lock goes with the transaction
+    await db.execute(select(func.pg_advisory_xact_lock(CACHE_LOCK)))
+    # a worker that waited for the lock finds the version another wrote
+    if not (missing_only and load() is not None):
+        with metrics.timer('columnar_refresh'):
+            root = Path(STATS_CACHE_DIR)
+            root.mkdir(parents=True, exist_ok=True)
+            path = root / f'.{os.getpid()}.copy'
+            try:
+                connection = await (await db.connection()).get_raw_connection()
+                await connection.driver_connection.copy_from_query(
+                    QUERY, output=path, format='binary')
+                columns = await asyncio.to_thread(build, path)
+            finally:
+                path.unlink(missing_ok=True)
+            await asyncio.to_thread(save, columns)
+
+    await db.commit()
+
+
+def build(path: Path) -> dict:
+    # the COPY output is read as a table of fixed size rows, every field
+    # is its length followed by a 4 byte integer
+    row = np.dtype([('fields', '>i2')] + [
+        (field, '>i4') for name in COLUMNS
+        for field in (f'{name}_length', name)])
+    with open(path, 'rb') as file:
+        # signature, flags and the length of the header extension
+        header = file.read(19)
+    offset = 19 + int.from_bytes(header[15:19], 'big')
+    # the file ends with a -1 field count
+    count = (path.stat().st_size - offset - 2) // row.itemsize
+    rows = (np.memmap(path, row, 'r', offset, (count,)) if count
+            else np.zeros(0, row))
+
+    columns = {name: rows[name].astype(np.int64) for name in COLUMNS}
+    # binary dates count days from 2000-01-01
+    columns['date'] = np.datetime64('2000-01-01', 'D') + rows['date']
+    del rows
+
+    groups, starts = np.unique(columns['group_id'], return_index=True)
+    columns['groups'], columns['starts'] = groups, starts
+
+    # recency weighted sums as of today, scoring decays them further
+    # by the days since the refresh
+    today = np.datetime64(date.today())
+    columns['weighted_at'] = np.array([today])
+    weights = np.exp2(-(today - columns['date']).astype(np.float64)
+                      / SCORE_HALF_LIFE)
+    for name in TOTALS:
+        columns[f'total_{name}'] = (np.add.reduceat(columns[name], starts)
+                                    if count else groups)
+        columns[f'weighted_{name}'] = (
+            np.add.reduceat(columns[name] * weights, starts)
+            if count else groups.astype(np.float64))
+
+    return columns
+
+
+def save(columns: dict) -> None:
+    # every version gets its own files and the manifest pointing at them
+    # is swapped in last, readers only ever see a complete version
+    root = Path(STATS_CACHE_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    version = str(time.time_ns())
+
+    for name, values in columns.items():
+        np.save(root / f'{version}.{name}.npy', values)
+
+    previous = _read_manifest()
+    with open(root / f'.{version}.{MANIFEST}', 'w') as file:
+        json.dump({'version': version, 'format': FORMAT,
+                   'columns': list(columns),
+                   'rows': len(columns['group_id'])}, file)
+    os.replace(root / f'.{version}.{MANIFEST}', root / MANIFEST)
+
+    if previous:
+        for name in previous['columns']:
+            (root / f'{previous["version"]}.{name}.npy').unlink(
+                missing_ok=True)
+
+
+def _read_manifest() -> Optional[dict]:
+    try:
+        with open(Path(STATS_CACHE_DIR, MANIFEST)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def load() -> Optional[dict]:
+    # every worker maps the latest version written by whichever of them
+    # ran the ingest
+    if not enabled():
+        return None
+
+    # a version replaced between reading the manifest and its files is
+    # gone, the manifest then points at the newer one
+    for _ in range(2):
+        manifest = _read_manifest()
+        if manifest is None or manifest.get('format') != FORMAT:
+            return None
+        if manifest['version'] == _snapshot['version']:
+            break
+
+        root = Path(STATS_CACHE_DIR)
+        try:
+            columns = {name: np.load(root / f'{manifest["version"]}.{name}'
+                                            '.npy', mmap_mode='r')
+                       for name in manifest['columns']}
+        except FileNotFoundError:
+            continue
+        _snapshot.update(version=manifest['version'], columns=columns)
+        break
+
+    return _snapshot['columns']
+
+
+def group_kpis(group_ids: Iterable[int]) -> Optional[dict]:
+    columns = load()
+    if columns is None:
+        return None
+
+    groups, starts = columns['groups'], columns['starts']
+    if not len(groups):
+        return {}
+
+    with metrics.timer('columnar_kpis'):
+        ids = np.fromiter(group_ids, np.int64)
+        pos = np.minimum(np.searchsorted(groups, ids), len(groups) - 1)
+        known = groups[pos] == ids
+
+        cost = columns['total_cost'][pos]
+        clicks = columns['total_clicks'][pos]
+        follows = columns['total_new_follows'][pos]
+        reach = columns['total_reach_all'][pos]
+
+        # the same sums over the last TREND_DAYS, a ratio above 1 means a
+        # click got more expensive lately
+        recent = columns['date'] >= np.datetime64(
+            date.today() - timedelta(days=TREND_DAYS))
+        recent_cost = np.add.reduceat(
+            np.where(recent, columns['cost'], 0), starts)[pos]
+        recent_clicks = np.add.reduceat(
+            np.where(recent, columns['clicks'], 0), starts)[pos]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cpc = cost / clicks
+            cpm = cost * 1000 / reach
+            follow_rate = follows / clicks
+            trend = recent_cost / recent_clicks / cpc
+
+    values = zip(ids[known].tolist(), _finite(cpc[known]),
+                 _finite(cpm[known]), _finite(follow_rate[known], 3),
+                 _finite(trend[known], 2))
+    return {i: {'cpc': cpc, 'cpm': cpm, 'follow_rate': follow_rate,
+                'trend': trend}
+            for i, cpc, cpm, follow_rate, trend in values}
+
+
+def _finite(values: 'np.ndarray', digits: int = 0) -> list:
+    cast = float if digits else int
+    return [cast(value) if math.isfinite(value) else None
+            for value in np.round(values, digits).tolist()]
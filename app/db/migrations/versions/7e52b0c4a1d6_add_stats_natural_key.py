@@ -0,0 +1,31 @@
+"""add stats natural key
+
+Revision ID: 7e52b0c4a1d6
+Revises: 3c1f8a2d9e47
+Create Date: 2026-10-18 11:03:27.218644
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e52b0c4a1d6'
+down_revision = '3c1f8a2d9e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # overlapping updates used to insert the same placement twice,
+    # keep the most recently written copy
+    op.execute(
+        'DELETE FROM stats a USING stats b '
+        'WHERE a.id < b.id AND a.date = b.date '
+        'AND a.group_id = b.group_id AND a.post_name = b.post_name'
+    )
+    op.create_unique_constraint('uq_stats_date_group_id_post_name', 'stats', ['date', 'group_id', 'post_name'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_stats_date_group_id_post_name', 'stats', type_='unique')
@@ -0,0 +1,81 @@
+"""partition stats by year
+
+Revision ID: a6e3d81f4c92
+Revises: 0d6b2f9a7c51
+Create Date: 2026-10-18 16:42:11.308527
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6e3d81f4c92'
+down_revision = '0d6b2f9a7c51'
+branch_labels = None
+depends_on = None
+
+COLUMNS = ('id, date, post_name, group_id, followers, reach_daily, cost, '
+           'clicks, new_follows, reach_all, reach_followers, likes, shares, '
+           'comments')
+
+
+def create_stats(partitioned: bool) -> None:
+    op.create_table('stats',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('stats_id_seq')"), nullable=False),
+    sa.Column('date', sa.Date(), nullable=not partitioned),
+    sa.Column('post_name', sa.String(), nullable=True),
+    sa.Column('group_id', sa.Integer(), nullable=True),
+    sa.Column('followers', sa.Integer(), nullable=True),
+    sa.Column('reach_daily', sa.Integer(), nullable=True),
+    sa.Column('cost', sa.Integer(), nullable=True),
+    sa.Column('clicks', sa.Integer(), nullable=True),
+    sa.Column('new_follows', sa.Integer(), nullable=True),
+    sa.Column('reach_all', sa.Integer(), nullable=True),
+    sa.Column('reach_followers', sa.Integer(), nullable=True),
+    sa.Column('likes', sa.Integer(), nullable=True),
+    sa.Column('shares', sa.Integer(), nullable=True),
+    sa.Column('comments', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['group_id'], ['groups.id'], name='stats_group_id_fkey', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', *(['date'] if partitioned else [])),
+    sa.UniqueConstraint('date', 'group_id', 'post_name', name='uq_stats_date_group_id_post_name'),
+    postgresql_partition_by='RANGE (date)' if partitioned else None
+    )
+    op.execute('ALTER SEQUENCE stats_id_seq OWNED BY stats.id')
+    op.create_index('ix_stats_group_id_date', 'stats', ['group_id', sa.text('date DESC')], unique=False)
+
+
+def move_stats(create) -> None:
+    # the new table takes over the names, so the old one gives them up
+    op.rename_table('stats', 'stats_old')
+    op.execute('ALTER INDEX stats_pkey RENAME TO stats_old_pkey')
+    op.execute('ALTER INDEX ix_stats_group_id_date '
+               'RENAME TO ix_stats_old_group_id_date')
+    op.execute('ALTER INDEX uq_stats_date_group_id_post_name '
+               'RENAME TO uq_stats_old_date_group_id_post_name')
+    op.execute('ALTER SEQUENCE stats_id_seq OWNED BY NONE')
+    create()
+    op.execute(f'INSERT INTO stats ({COLUMNS}) '
+               f'SELECT {COLUMNS} FROM stats_old')
+    op.drop_table('stats_old')
+
+
+def upgrade() -> None:
+    # rows without a date have no partition to go to, nothing reads them
+    op.execute('DELETE FROM stats WHERE date IS NULL')
+    years = op.get_bind().scalars(sa.text(
+        'SELECT DISTINCT extract(year FROM date)::int FROM stats')).all()
+
+    def create() -> None:
+        create_stats(partitioned=True)
+        op.create_index('ix_stats_date', 'stats', ['date'], unique=False, postgresql_using='brin')
+        for year in years:
+            op.execute(f'CREATE TABLE stats_{year} PARTITION OF stats '
+                       f"FOR VALUES FROM ('{year}-01-01') "
+                       f"TO ('{year + 1}-01-01')")
+
+    move_stats(create)
+
+
+def downgrade() -> None:
+    move_stats(lambda: create_stats(partitioned=False))
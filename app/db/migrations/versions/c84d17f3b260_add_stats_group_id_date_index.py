@@ -0,0 +1,26 @@
+"""add stats group_id date index
+
+Revision ID: c84d17f3b260
+Revises: 7e52b0c4a1d6
+Create Date: 2026-10-18 11:48:05.631940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c84d17f3b260'
+down_revision = '7e52b0c4a1d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_stats_group_id_date', 'stats', ['group_id', sa.text('date DESC')], unique=False)
+    op.drop_index('ix_stats_group_id', table_name='stats')
+
+
+def downgrade() -> None:
+    op.create_index('ix_stats_group_id', 'stats', ['group_id'], unique=False)
+    op.drop_index('ix_stats_group_id_date', table_name='stats')
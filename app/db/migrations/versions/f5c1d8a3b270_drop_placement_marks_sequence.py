@@ -0,0 +1,28 @@
+"""drop placement marks sequence
+
+Revision ID: f5c1d8a3b270
+Revises: 8b3e5f1a2c94
+Create Date: 2026-10-19 00:21:15.904316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5c1d8a3b270'
+down_revision = '8b3e5f1a2c94'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # group_id holds vk group ids, databases created before it was marked
+    # autoincrement=False got a serial default nobody uses
+    op.alter_column('placement_marks', 'group_id', server_default=None,
+                    existing_type=sa.Integer(), existing_nullable=False)
+    op.execute('DROP SEQUENCE IF EXISTS placement_marks_group_id_seq')
+
+
+def downgrade() -> None:
+    pass
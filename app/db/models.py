@@ -1,5 +1,8 @@
-from sqlalchemy import Column, Date, ForeignKey, Integer, String
+from sqlalchemy import (JSON, Boolean, Column, Date, DateTime, Float,
+                        ForeignKey, Index, Integer, String, UniqueConstraint,
+                        text)
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.sql import func
 
 Base = declarative_base()
 
@@ -21,11 +24,20 @@ class GroupModel(Base):
 
 class StatsModel(Base):
     __tablename__ = 'stats'
+    __table_args__ = (
+        UniqueConstraint('date', 'group_id', 'post_name',
+                         name='uq_stats_date_group_id_post_name'),
+        Index('ix_stats_group_id_date', 'group_id', text('date DESC')),
+        Index('ix_stats_date', 'date', postgresql_using='brin'),
+        # one partition per year, the writer adds them as data arrives
+        {'postgresql_partition_by': 'RANGE (date)'},
+    )
 
+    # every key of a partitioned table has to include the partition key
     id = Column(Integer, autoincrement=True, primary_key=True)
-    date = Column(Date)
+    date = Column(Date, primary_key=True)
     post_name = Column(String)
-    group_id = Column(ForeignKey('groups.id', ondelete='CASCADE'), index=True)
+    group_id = Column(ForeignKey('groups.id', ondelete='CASCADE'))
     followers = Column(Integer)
     reach_daily = Column(Integer)
     cost = Column(Integer)
@@ -38,6 +50,16 @@ class StatsModel(Base):
     comments = Column(Integer)
 
 
+class StatsDailyModel(Base):
+    __tablename__ = 'stats_daily'
+
+    date = Column(Date, primary_key=True)
+    post_name = Column(String, primary_key=True)
+    cost = Column(Integer)
+    clicks = Column(Integer)
+    reach_all = Column(Integer)
+
+
 class ActiveModel(Base):
     __tablename__ = 'active'
 
@@ -45,3 +67,49 @@ class ActiveModel(Base):
     date = Column(Date)
     group_id = Column(ForeignKey('groups.id', ondelete='CASCADE'), index=True)
     cost = Column(Integer)
+    fetched_at = Column(DateTime, server_default=func.now())
+
+
+class ActiveSnapshotModel(Base):
+    __tablename__ = 'active_snapshot'
+
+    # a single row, when the active/pending overviews were last stored
+    fetched_at = Column(DateTime, primary_key=True)
+
+
+class BackfillChunkModel(Base):
+    __tablename__ = 'backfill_chunks'
+
+    start_date = Column(Date, primary_key=True)
+    end_date = Column(Date)
+    rows = Column(Integer)
+    loaded_at = Column(DateTime)
+
+
+class IngestWatermarkModel(Base):
+    __tablename__ = 'ingest_watermarks'
+
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+    rows = Column(Integer)
+    fetched_at = Column(DateTime, nullable=False)
+
+
+class SyncRunModel(Base):
+    __tablename__ = 'sync_runs'
+
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    started_at = Column(DateTime, nullable=False)
+    duration = Column(Float)
+    rows = Column(Integer)
+    error = Column(String)
+    gaps = Column(JSON)
+
+
+class PlacementMarkModel(Base):
+    __tablename__ = 'placement_marks'
+
+    group_id = Column(Integer, primary_key=True, autoincrement=False)
+    cached = Column(Boolean, default=False, nullable=False)
+    skipped = Column(Boolean, default=False, nullable=False)
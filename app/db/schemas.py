@@ -1,20 +1,11 @@
 from datetime import date
+from typing import NamedTuple
 
-from pydantic import BaseModel
+# parsed rows are plain tuples in column order, they go to the database
+# through COPY as they are, without a dict, model or ORM object per row
 
 
-class ModifiedModel(BaseModel):
-
-    class Config:
-        orm_mode = True
-
-
-class GroupSchema(ModifiedModel):
-    id: int
-    name: str
-
-
-class StatsSchema(ModifiedModel):
+class StatsRow(NamedTuple):
     date: date
     post_name: str
     group_id: int
@@ -30,7 +21,7 @@ class StatsSchema(ModifiedModel):
     comments: int
 
 
-class ActiveSchema(ModifiedModel):
+class ActiveRow(NamedTuple):
     date: date
     group_id: int
     cost: int
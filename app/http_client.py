@@ -0,0 +1,45 @@
+import time
+from contextlib import asynccontextmanager
+from http.cookiejar import DefaultCookiePolicy
+from typing import AsyncIterator
+
+import httpx
+import metrics
+from settings import HEADERS, HTTP_POOL_SIZE, HTTP_TIMEOUT, URL
+
+client = httpx.AsyncClient(
+    headers={**HEADERS, 'Accept-Encoding': 'gzip, deflate'},
+    timeout=httpx.Timeout(HTTP_TIMEOUT[1], connect=HTTP_TIMEOUT[0]),
+    limits=httpx.Limits(max_connections=HTTP_POOL_SIZE,
+                        max_keepalive_connections=HTTP_POOL_SIZE),
+)
+# credentials are sent with every call, cookies vk sets on a response
+# must not leak into the next call through the shared jar
+client.cookies.jar.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+
+def cookie_header(cookies: dict) -> dict:
+    return {'Cookie': '; '.join(f'{k}={v}' for k, v in cookies.items())}
+
+
+async def post(params: dict, cookies: dict, data: dict) -> httpx.Response:
+    started = time.perf_counter()
+    response = await client.post(url=URL, params=params, data=data,
+                                 headers=cookie_header(cookies))
+    metrics.observe(f'vk_{params["act"]}', time.perf_counter() - started)
+    metrics.count(f'vk_{params["act"]}_bytes',
+                  response.num_bytes_downloaded)
+    return response
+
+
+@asynccontextmanager
+async def stream(params: dict, cookies: dict,
+                 data: dict) -> AsyncIterator[httpx.Response]:
+    started = time.perf_counter()
+    async with client.stream('POST', url=URL, params=params, data=data,
+                             headers=cookie_header(cookies)) as response:
+        # streamed calls are timed up to the response headers
+        metrics.observe(f'vk_{params["act"]}', time.perf_counter() - started)
+        yield response
+        metrics.count(f'vk_{params["act"]}_bytes',
+                      response.num_bytes_downloaded)
@@ -0,0 +1,147 @@
+import asyncio
+import time
+from datetime import date, datetime
+from typing import AsyncIterator, Optional
+
+import columnar
+import metrics
+from db.models import IngestWatermarkModel, StatsModel, SyncRunModel
+from db.schemas import StatsRow
+from db.session import SessionLocal
+from parsers import (SessionExpired, fetch_stats, get_cookies, get_placements,
+                     renew_cookies)
+from settings import MESSAGES, REFRESH_INTERVAL
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from utils import write_to_db
+from watermarks import plan_sync
+
+# advisory lock key shared by all workers, only one of them refreshes
+REFRESH_LOCK = 20230518
+
+
+class SyncError(Exception):
+
+    def __init__(self, message: str):
+        super().__init__(MESSAGES[message])
+        self.message = message
+
+
+async def sync_stats(db: AsyncSession, fill_gaps: bool = False
+                     ) -> (int, list[tuple[date, date]]):
+    last_date: date = await db.scalar(
+        select(StatsModel.date).order_by(StatsModel.date.desc()).limit(1))
+
+    if last_date is None:
+        raise SyncError('failed_init')
+
+    # gaps are day ranges no run has fetched yet, filled a few per run
+    ranges, gaps = await plan_sync(db, last_date, fill_gaps)
+    metrics.count('stats_exports', len(ranges))
+
+    credentials = await get_cookies(db)
+    fetched_at = datetime.now()
+
+    try:
+        try:
+            # a savepoint, so a retry starts from a clean transaction
+            async with db.begin_nested():
+                rows, counts = await write_sync(db, *credentials, ranges)
+        except SessionExpired:
+            # the sync is run once more if other cookies were stored
+            # since these were cached
+            credentials = await renew_cookies(db, credentials)
+            if credentials is None:
+                raise
+            async with db.begin_nested():
+                rows, counts = await write_sync(db, *credentials, ranges)
+    except UnicodeDecodeError:
+        raise SyncError('failed_init')
+    except SessionExpired:
+        raise SyncError('failed_cookies')
+
+    # committed together with the rows, a failed run leaves no watermark
+    # and its days are fetched again
+    for (start, end), count in zip(ranges, counts):
+        db.add(IngestWatermarkModel(start_date=start, end_date=end,
+                                    rows=count, fetched_at=fetched_at))
+    await db.commit()
+
+    return rows, gaps
+
+
+async def write_sync(db: AsyncSession, cookies: dict, hash_curl: str,
+                     ranges: list[tuple[date, date]]) -> (int, list[int]):
+    active, groups = await get_placements(cookies)
+    counts = [0] * len(ranges)
+
+    async def exports() -> AsyncIterator[StatsRow]:
+        # the ranges are streamed one after another into a single write
+        for i, (start, end) in enumerate(ranges):
+            async for row in fetch_stats(cookies, hash_curl, start, end,
+                                         groups):
+                counts[i] += 1
+                yield row
+
+    # the snapshot is replaced at the end of the write, right before the
+    # commit, /pending doesn't wait for the download
+    rows = await write_to_db(
+        db=db, stats=exports(), groups=groups,
+        active=active, commit=False)
+
+    return rows, counts
+
+
+async def run_sync(db: AsyncSession, wait: bool = True,
+                   fill_gaps: bool = False) -> Optional[int]:
+    # the lock is released by the commit at the end of the sync, the
+    # background refresh skips a sync another worker is already doing
+    if wait:
+        await db.execute(select(func.pg_advisory_xact_lock(REFRESH_LOCK)))
+    elif not await db.scalar(
+            select(func.pg_try_advisory_xact_lock(REFRESH_LOCK))):
+        return None
+
+    run = SyncRunModel(started_at=datetime.now())
+    started = time.perf_counter()
+    try:
+        rows, gaps = await sync_stats(db, fill_gaps)
+        # a refresh that skipped the export left stats as they were
+        if rows:
+            await columnar.refresh(db)
+    except Exception as exc:
+        run.error = str(exc) or repr(exc)
+        raise
+    else:
+        run.rows = rows
+        run.gaps = [[start.isoformat(), end.isoformat()]
+                    for start, end in gaps]
+    finally:
+        run.duration = time.perf_counter() - started
+        # a session of its own, a failed sync rolls its transaction back
+        async with SessionLocal() as log:
+            log.add(run)
+            await log.commit()
+
+    return rows
+
+
+async def job_status(db: AsyncSession) -> dict:
+    run = await db.scalar(
+        select(SyncRunModel).order_by(SyncRunModel.id.desc()).limit(1))
+    if run is None:
+        run = SyncRunModel()
+
+    return {'last_run': run.started_at, 'duration': run.duration,
+            'rows_written': run.rows, 'error': run.error,
+            'gaps': run.gaps or []}
+
+
+async def refresh_loop() -> None:
+    while True:
+        async with SessionLocal() as db:
+            try:
+                await run_sync(db, wait=False, fill_gaps=True)
+            except Exception as exc:
+                print(f'background stats refresh failed: {exc!r}')
+        await asyncio.sleep(REFRESH_INTERVAL)
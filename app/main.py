@@ -1,136 +1,215 @@
+import asyncio
 from datetime import date, datetime
-from typing import Optional
-
-from db.models import ActiveModel, Cookies, StatsModel
-from db.session import get_db
+from typing import AsyncIterator, Optional
+
+import columnar
+import http_client
+from backfill import load_history
+from db.models import BackfillChunkModel, Cookies, StatsDailyModel, StatsModel
+from db.schemas import ActiveRow
+from db.session import SessionLocal, get_db
 from fastapi import Depends, FastAPI, Form, Request
-from fastapi.responses import HTMLResponse
-from parsers import get_active, get_selection, get_stats
-from settings import MESSAGES, START_YEAR, STATUSES
-from sqlalchemy.orm import Session
-from sqlalchemy.sql import func
-from utils import (extract_cookies, get_context, get_group_instances,
-                   render_template, write_to_db)
+from fastapi.responses import (HTMLResponse, JSONResponse, PlainTextResponse,
+                               StreamingResponse)
+from httpx import HTTPError
+from jobs import SyncError, job_status, refresh_loop, run_sync
+from metrics import TimingMiddleware, prometheus
+from parsers import (SessionExpired, cookies_cache, get_cookies,
+                     get_placements, get_selection, renew_cookies,
+                     selection_cache)
+from settings import MESSAGES, REFRESH_INTERVAL, TIMING_LOG
+from sqlalchemy import delete, exists, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from utils import (PENDING_LOCK, extract_cookies, get_active_ids, get_context,
+                   get_marks, get_pending, is_active_fresh, iter_context,
+                   load_templates, lock, mark_cached, render_template,
+                   skip_cached, stream_template, write_to_db)
 
 app = FastAPI()
-cache = set()
-skipped = set()
+app.add_middleware(TimingMiddleware, log=TIMING_LOG)
 
 # this comment is made from Achijho 2390
 
+
+@app.on_event('startup')
+async def compile_templates():
+    load_templates()
+
+
+@app.on_event('startup')
+async def load_stats_cache():
+    if columnar.enabled() and columnar.load() is None:
+        async with SessionLocal() as db:
+            await columnar.refresh(db, missing_only=True)
+
+
+@app.on_event('startup')
+async def start_refresh():
+    if REFRESH_INTERVAL:
+        app.state.refresh = asyncio.create_task(refresh_loop())
+
+
+@app.on_event('shutdown')
+async def close_http_client():
+    if REFRESH_INTERVAL:
+        app.state.refresh.cancel()
+    await http_client.client.aclose()
+
+
+@app.exception_handler(HTTPError)
+async def vk_error_handler(request: Request, exc: HTTPError):
+    # scripts calling the json api need a failing status, not the page
+    if request.url.path.startswith('/api/'):
+        return JSONResponse({'error': MESSAGES['failed_vk']}, status_code=502)
+    return render_template(request=request, message=MESSAGES['failed_vk'])
+
+
 @app.get('/', response_class=HTMLResponse)
-def index(request: Request):
+async def index(request: Request):
     return render_template(request=request)
 
 
 @app.post('/update_stats')
-def update_stats_handler(request: Request, db: Session = Depends(get_db)):
-    last_date: date = db.query(
-        StatsModel.date).order_by(StatsModel.date.desc()).limit(1).scalar()
-
+async def update_stats_handler(request: Request,
+                               db: AsyncSession = Depends(get_db)):
     try:
-        stats_instances, groups = get_stats(db=db, start_date=last_date)
-    except UnicodeEncodeError:
+        await run_sync(db)
+    except SyncError as exc:
         return render_template(
-            request=request, message=MESSAGES['failed_init'])
+            request=request, message=MESSAGES[exc.message])
 
-    if not stats_instances:
-        return render_template(
-            request=request, message=MESSAGES['failed_cookies'])
+    return render_template(
+        request=request, message=MESSAGES['success_stats_update'])
 
-    active_instances, active_groups = get_active(db, STATUSES['active'])
-    pending_instances, pending_groups = get_active(db, STATUSES['pending'])
 
-    groups.update(active_groups)
-    groups.update(pending_groups)
+@app.get('/jobs')
+async def jobs_handler(db: AsyncSession = Depends(get_db)):
+    return {'update_stats': {**await job_status(db),
+                             'interval': REFRESH_INTERVAL}}
 
-    group_instances = get_group_instances(groups)
-    db.query(StatsModel).filter_by(date=last_date).delete()
-    db.query(ActiveModel).delete()
-    write_to_db(db=db, stats=stats_instances, groups=group_instances,
-                active=active_instances + pending_instances)
 
-    return render_template(
-        request=request, message=MESSAGES['success_stats_update'])
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics_handler(db: AsyncSession = Depends(get_db)):
+    status = await job_status(db)
+    return prometheus(
+        counters={'selection_cache_hits': selection_cache.hits,
+                  'selection_cache_misses': selection_cache.misses,
+                  'cookies_cache_hits': cookies_cache.hits,
+                  'cookies_cache_misses': cookies_cache.misses},
+        gauges={'selection_cache_size': len(selection_cache),
+                'last_sync_duration_seconds': status['duration'],
+                'last_sync_rows_written': status['rows_written']})
 
 
 @app.post('/load_stats')
-def load_stats_handler(request: Request, db: Session = Depends(get_db)):
-    not_empty = db.query(StatsModel).count() != 0
-    if not_empty:
+async def load_stats_handler(request: Request,
+                             db: AsyncSession = Depends(get_db)):
+    # a load that was interrupted leaves its checkpoints behind and may
+    # be resumed, stats without checkpoints were loaded some other way
+    not_empty = await db.scalar(select(exists().select_from(StatsModel)))
+    resuming = await db.scalar(
+        select(exists().select_from(BackfillChunkModel)))
+    if not_empty and not resuming:
         return render_template(
             request=request, message=MESSAGES['failed_stats_load'])
 
-    stats_instances, groups = [], {}
-    current_year = date.today().year
-    chunks = [
-        ('0101', '0331'), ('0401', '0630'), ('0701', '0930'), ('1001', '1231')
-    ]
-    for year in range(START_YEAR, current_year + 1):
-        for chunk in chunks:
-            # year - month - day
-            start_date = f'{year}{chunk[0]}'
-            end_date = f'{year}{chunk[1]}'
-            cur_stats, cur_groups = get_stats(db, start_date, end_date)
-            if cur_stats is None:
-                return render_template(
-                    request=request, message=MESSAGES['failed_cookies'])
-            stats_instances.extend(cur_stats)
-            groups.update(cur_groups)
-            print(f'{year}{chunk[0]} - {year}{chunk[1]} processed')
+    if await load_history(db) is None:
+        return render_template(
+            request=request, message=MESSAGES['failed_cookies'])
 
-    group_instances = get_group_instances(groups)
-    write_to_db(db=db, stats=stats_instances, groups=group_instances)
+    await columnar.refresh(db)
 
     return render_template(
         request=request, message=MESSAGES['success_stats_load'])
 
 
-@app.post('/analyze', response_class=HTMLResponse)
-def analyze_handler(request: Request, url: Optional[str] = Form(None),
-                    db: Session = Depends(get_db)):
+async def find_selection(db: AsyncSession,
+                         url: Optional[str]) -> (Optional[dict], str):
     if not url:
-        return render_template(
-            request=request, message=MESSAGES['failed_no_url'])
+        return None, 'failed_no_url'
+
+    credentials = await get_cookies(db)
 
     try:
-        selection = get_selection(db, url)
+        selection = await get_selection(credentials[0], url)
+        if not selection:
+            # another worker may have stored fresh cookies in the meantime
+            credentials = await renew_cookies(db, credentials)
+            if credentials is not None:
+                selection = await get_selection(credentials[0], url)
     except (KeyError, ValueError):
-        return render_template(
-            request=request, message=MESSAGES['failed_invalid_url'])
+        return None, 'failed_invalid_url'
 
     if not selection:
-        return render_template(
-            request=request, message=MESSAGES['failed_cookies'])
+        return None, 'failed_cookies'
+
+    return selection, ''
 
-    context = get_context(db, selection)
 
-    active_data = db.query(ActiveModel).where(
-        ActiveModel.group_id.in_(selection.keys()))
-    active_items = [item.group_id for item in active_data]
+async def stream_analysis(request: Request, db: AsyncSession,
+                          selection: dict,
+                          sort: Optional[str]) -> AsyncIterator[str]:
+    active_items = await get_active_ids(db, selection.keys())
+    cache, skipped = await get_marks(db, selection.keys())
 
-    for group_idx, data in selection.items():
-        if group_idx not in context:
-            context[group_idx] = {
-                'group_name': data[0],
-                'cost': data[1],
-                'reach': f'{data[2] // 1000} / {data[3] // 1000}',
-                'data': None,
-            }
+    async for chunk in stream_template(
+            request=request, context=iter_context(db, selection, sort),
+            cache=cache, skipped=skipped, active=active_items):
+        yield chunk
 
-    context = dict(sorted(context.items()))
+    await mark_cached(db, selection.keys())
+
+
+@app.post('/analyze', response_class=HTMLResponse)
+async def analyze_handler(request: Request, url: Optional[str] = Form(None),
+                          sort: Optional[str] = Form(None),
+                          stream: bool = False, fragment: bool = False,
+                          db: AsyncSession = Depends(get_db)):
+    selection, error = await find_selection(db, url)
+    if error:
+        return render_template(request=request, message=MESSAGES[error])
+
+    # rows are sent while the history of the next groups is still read
+    if stream:
+        return StreamingResponse(
+            stream_analysis(request, db, selection, sort),
+            media_type='text/html')
+
+    context = await get_context(db, selection, sort)
+    active_items = await get_active_ids(db, selection.keys())
+    cache, skipped = await get_marks(db, selection.keys())
 
     template = render_template(request=request, context=context, cache=cache,
-                               active=active_items, skipped=skipped)
+                               active=active_items, skipped=skipped,
+                               fragment='analysis' if fragment else None)
 
-    cache.update(selection.keys())
+    await mark_cached(db, selection.keys())
 
     return template
 
 
+@app.post('/api/analyze')
+async def analyze_api_handler(url: Optional[str] = Form(None),
+                              sort: Optional[str] = Form(None),
+                              db: AsyncSession = Depends(get_db)):
+    selection, error = await find_selection(db, url)
+    if error:
+        return JSONResponse({'error': MESSAGES[error]}, status_code=400)
+
+    active_items = set(await get_active_ids(db, selection.keys()))
+    cache, skipped = await get_marks(db, selection.keys())
+
+    # read-only, unlike the page it does not mark the groups as seen
+    return {'groups': [
+        {'group_id': group_id, **group_data,
+         'active': group_id in active_items,
+         'cached': group_id in cache, 'skipped': group_id in skipped}
+        async for group_id, group_data in iter_context(db, selection, sort)]}
+
+
 @app.post('/update_cookies')
-def update_cookies_handler(request: Request, curl: str = Form(None),
-                           db: Session = Depends(get_db)):
+async def update_cookies_handler(request: Request, curl: str = Form(None),
+                                 db: AsyncSession = Depends(get_db)):
     if not curl:
         return render_template(
             request=request, message=MESSAGES['failed_no_curl'])
@@ -149,61 +228,86 @@ def update_cookies_handler(request: Request, curl: str = Form(None),
         return render_template(
             request=request, message=MESSAGES['failed_invalid_curl'])
 
-    db.query(Cookies).delete()
+    await db.execute(delete(Cookies))
     cookies = Cookies(remixsid=remixsid, remixnsid=remixnsid, hash=curl_hash)
     db.add(cookies)
-    db.commit()
+    await db.commit()
+    cookies_cache.clear()
 
     return render_template(
         request=request, message=MESSAGES['success_cookies'])
 
 
-@app.get('/pending', response_class=HTMLResponse)
-def pending_total_handler(request: Request, db: Session = Depends(get_db)):
-    active_instances, _ = get_active(db, STATUSES['active'])
-    pending_instances, _ = get_active(db, STATUSES['pending'])
+async def fetch_placements(db: AsyncSession) -> (list[ActiveRow], dict):
+    credentials = await get_cookies(db)
+    try:
+        return await get_placements(credentials[0])
+    except SessionExpired:
+        # another worker may have stored fresh cookies in the meantime
+        credentials = await renew_cookies(db, credentials)
+        if credentials is None:
+            raise
+        return await get_placements(credentials[0])
 
-    pending = {}
 
-    for item in active_instances + pending_instances:
-        dt = item.date.strftime('%d %B %y')
-        pending[dt] = pending.get(dt, 0) + item.cost
+@app.get('/pending', response_class=HTMLResponse)
+async def pending_total_handler(request: Request, fragment: bool = False,
+                                db: AsyncSession = Depends(get_db)):
+    # /update_stats stores the same overviews, vk is only asked again
+    # once that snapshot is older than PENDING_MAX_AGE
+    if not await is_active_fresh(db):
+        # a request that waited for another one's refresh finds the
+        # snapshot fresh and doesn't ask vk again
+        await lock(db, PENDING_LOCK)
+        if await is_active_fresh(db):
+            await db.rollback()
+        else:
+            # the stored snapshot is kept when vk rejects the cookies
+            try:
+                active, groups = await fetch_placements(db)
+            except SessionExpired:
+                return render_template(
+                    request=request, message=MESSAGES['failed_cookies'])
+            await write_to_db(db=db, stats=[], groups=groups, active=active)
 
-    pending = dict(sorted(pending.items()))
+    pending = await get_pending(db)
 
-    return render_template(request=request, pending=pending)
+    return render_template(request=request, pending=pending,
+                           fragment='pending' if fragment else None)
 
 
 @app.post('/performance')
-def performance_handler(request: Request, start: str = Form(None),
-                        db: Session = Depends(get_db)):
+async def performance_handler(request: Request, start: str = Form(None),
+                              fragment: bool = False,
+                              db: AsyncSession = Depends(get_db)):
     try:
-        dt = datetime.strptime(start, "%d%m%y").strftime('%d %B %y')
+        start_date = datetime.strptime(start, "%d%m%y").date()
     except (TypeError, ValueError):
         return render_template(
             request=request, message=MESSAGES['failed_date'])
 
-    today = date.today().strftime('%d %B %y')
+    today = date.today()
 
-    message = f'performance data for {dt} - {today}'
+    message = (f'performance data for {start_date.strftime("%d %B %y")} - '
+               f'{today.strftime("%d %B %y")}')
 
-    performance = db.query(
-        StatsModel.post_name,
-        func.sum(StatsModel.clicks).label('clicks'),
-        func.sum(StatsModel.cost).label('cost'),
-        func.sum(StatsModel.reach_all).label('reach')
-        ).where(StatsModel.date > dt).group_by(StatsModel.post_name)
+    performance = (await db.execute(select(
+        StatsDailyModel.post_name,
+        func.sum(StatsDailyModel.clicks).label('clicks'),
+        func.sum(StatsDailyModel.cost).label('cost'),
+        func.sum(StatsDailyModel.reach_all).label('reach')
+        ).where(StatsDailyModel.date.between(start_date, today)).group_by(
+            StatsDailyModel.post_name))).all()
 
     return render_template(request=request, message=message,
-                           performance=performance)
+                           performance=performance,
+                           fragment='performance' if fragment else None)
 
 
 @app.post('/clear_cache')
-def clear_cache_handler(request: Request):
-    global cache
-    global skipped
-    skipped.update(cache)
-    cache = set()
+async def clear_cache_handler(request: Request,
+                              db: AsyncSession = Depends(get_db)):
+    await skip_cached(db)
 
     return render_template(
         request=request, message=MESSAGES['success_cache'])
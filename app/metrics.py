@@ -0,0 +1,117 @@
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import Iterator, Optional
+
+_lock = Lock()
+_timings = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+_requests = defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+_counters = defaultdict(int)
+# stage totals of the request being served, None outside of requests
+_stages: ContextVar[Optional[dict]] = ContextVar('stages', default=None)
+
+
+def _add(timings: dict, name: str, seconds: float) -> None:
+    timing = timings[name]
+    timing['count'] += 1
+    timing['total'] += seconds
+    timing['max'] = max(timing['max'], seconds)
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        _add(_timings, name, seconds)
+    stages = _stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+def count(name: str, value: int = 1) -> None:
+    with _lock:
+        _counters[name] += value
+    stages = _stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0) + value
+
+
+@contextmanager
+def timer(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+
+def prometheus(counters: Optional[dict] = None,
+               gauges: Optional[dict] = None) -> str:
+    lines = []
+    with _lock:
+        for metric, label, timings in (
+                ('mp_stage_seconds', 'stage', _timings),
+                ('mp_request_seconds', 'handler', _requests)):
+            lines.append(f'# TYPE {metric} summary')
+            for name, timing in sorted(timings.items()):
+                labels = f'{{{label}="{name}"}}'
+                lines.append(f'{metric}_count{labels} {timing["count"]}')
+                lines.append(f'{metric}_sum{labels} {timing["total"]:.6f}')
+            lines.append(f'# TYPE {metric}_max gauge')
+            for name, timing in sorted(timings.items()):
+                lines.append(f'{metric}_max{{{label}="{name}"}} '
+                             f'{timing["max"]:.6f}')
+        totals = {**_counters, **(counters or {})}
+
+    for name, value in sorted(totals.items()):
+        lines.append(f'# TYPE mp_{name}_total counter')
+        lines.append(f'mp_{name}_total {value}')
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f'# TYPE mp_{name} gauge')
+        lines.append(f'mp_{name} {0 if value is None else value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class TimingMiddleware:
+    # times requests up to their last body chunk, streamed pages included,
+    # and optionally prints one json line per request with its stages
+
+    def __init__(self, app, log: bool = False):
+        self.app = app
+        self.log = log
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_status(message: dict) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        stages = {}
+        token = _stages.set(stages)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            duration = time.perf_counter() - started
+            _stages.reset(token)
+            endpoint = scope.get('endpoint')
+            handler = endpoint.__name__ if endpoint else 'unmatched'
+            with _lock:
+                _add(_requests, handler, duration)
+            if self.log:
+                print(json.dumps({
+                    'method': scope['method'], 'path': scope['path'],
+                    'handler': handler, 'status': status,
+                    'duration': round(duration, 6),
+                    'stages': {name: round(value, 6)
+                               for name, value in stages.items()},
+                }), flush=True)
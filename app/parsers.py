@@ -1,71 +1,183 @@
+import asyncio
 import re
+import time
 from datetime import date, timedelta
-from typing import Optional
+from functools import lru_cache
+from typing import AsyncIterator, Iterable, Iterator, Optional
+
+import archive
+import http_client
+import metrics
+from db.models import Cookies
+from db.schemas import ActiveRow, StatsRow
+from httpx import Response
+from settings import (COOKIES_TTL, PARAMS, SELECTION_CACHE_SIZE,
+                      SELECTION_CACHE_TTL, STATUSES, STREAM_CHUNK_SIZE, data)
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ttl_cache import TTLCache
+
+NON_DIGITS = re.compile(r'\D')
+
+# the fields of one community_search row, in the order vk prints them
+SELECTION_ROW = re.compile(
+    r'exchange_comm_name\\">(?P<group_name>.{0,200}?)<\\/a>'
+    r'.*?nowrap(?P<reach_post>.{0,200}?) \\/ (?P<reach_daily>.{0,200}?)'
+    r'человек<\\/td>(?P<price>.{0,200}?)<\\/b> руб'
+    r'.*?stats-(?P<group_idx>\d+)'
+)
+# everything but the digits of numbers joined with ';'
+NOT_NUMBERS = re.compile(r'[^\d;]')
+# al=1 pages come wrapped as <!--{"payload":[0,["..."]]}
+AJAX_ANSWER = re.compile(r'"payload":\["?(?P<code>\d+)')
+
+selection_cache = TTLCache(maxsize=SELECTION_CACHE_SIZE,
+                           ttl=SELECTION_CACHE_TTL)
+cookies_cache = TTLCache(maxsize=1, ttl=COOKIES_TTL)
+
+
+class SessionExpired(Exception):
+    pass
+
+
+async def fetch_stats(cookies: dict, hash_curl: str, start_date: date,
+                      end_date: Optional[date] = None,
+                      groups: Optional[dict] = None
+                      ) -> AsyncIterator[StatsRow]:
+    # rows are yielded while the export is still being downloaded and go
+    # straight into the writer, groups is filled along the way
+    end_date = end_date or date.today()
+    groups = {} if groups is None else groups
 
-import requests
-from db.models import ActiveModel, Cookies, StatsModel
-from db.schemas import ActiveSchema, StatsSchema
-from settings import HEADERS, PARAMS, STATUSES, URL, data
-from sqlalchemy.orm import Session
+    payload = {
+        **data,
+        'start_time': str(start_date).replace('-', ''),
+        'end_time': str(end_date).replace('-', ''),
+        'hash': hash_curl,
+    }
 
+    rows = 0
+    download = decode = convert = 0.0
 
-def get_stats(db: Session, start_date: date,
-              end_date: Optional[date] = None) -> (list[StatsModel], dict):
+    record = archive.recorder()
+    try:
+        async with http_client.stream(params=PARAMS, cookies=cookies,
+                                      data=payload) as response:
+            # the export is cp1251 encoded, lines are decoded one at a time
+            # while the rest of the body is still being downloaded
+            lines = iter_lines(response, record)
+
+            header = b''
+            async for header in lines:
+                break
+            # an expired session gets a short json error instead of the
+            # export, it is told apart by its first line before any row
+            if 'payload' in header.decode('cp1251'):
+                cookies_cache.clear()
+                raise SessionExpired
+
+            while True:
+                started = time.perf_counter()
+                try:
+                    line = await lines.__anext__()
+                except StopAsyncIteration:
+                    break
+                split = time.perf_counter()
+                col = split_stats_line(line)
+                if col is None:
+                    break
+                converted = time.perf_counter()
+                row = to_stats_row(col, groups)
+                download += split - started
+                decode += converted - split
+                convert += time.perf_counter() - converted
+                rows += 1
+                yield row
+
+            # drain the totals tail so the connection goes back to the pool
+            async for _ in lines:
+                pass
+
+        if record:
+            await record.save(f'get_export_stats/{payload["start_time"]}-'
+                              f'{payload["end_time"]}')
+    finally:
+        if record:
+            record.discard()
+
+    metrics.observe('stats_download', download)
+    metrics.observe('stats_decode', decode)
+    metrics.observe('stats_convert', convert)
+    metrics.count('stats_rows', rows)
+
+
+async def iter_lines(response: Response,
+                     record: Optional[archive.Recorder] = None
+                     ) -> AsyncIterator[bytes]:
+    tail = b''
+    async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+        if record:
+            await record.feed(chunk)
+        *lines, tail = (tail + chunk).split(b'\n')
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+
+def iter_stats(lines: Iterable[bytes], groups: dict) -> Iterator[StatsRow]:
+    for line in lines:
+        row = parse_stats_line(line, groups)
+        if row is None:
+            break
+        yield row
 
-    end_date = end_date or date.today()
-    cookies, hash_curl = get_cookies(db)
 
-    data['start_time'] = str(start_date).replace('-', '')
-    data['end_time'] = str(end_date).replace('-', '')
-    data['hash'] = hash_curl
+def parse_stats_line(line: bytes, groups: dict) -> Optional[StatsRow]:
+    col = split_stats_line(line)
+    return None if col is None else to_stats_row(col, groups)
 
-    response = requests.post(url=URL, params=PARAMS, cookies=cookies,
-                             headers=HEADERS, data=data)
-    try:
-        decoded_response = response.text.encode('latin1').decode('cp1251')
-    except UnicodeEncodeError:
-        raise
 
-    split_response = decoded_response.split('\n')
+def split_stats_line(line: bytes) -> Optional[list[str]]:
+    col = line.decode('cp1251').split(';')
+    return None if col[0] == 'Всего' else col
 
-    if 'payload' in split_response[0]:
-        return None, None
 
-    objects, groups = [], {}
+def to_stats_row(col: list[str], groups: dict) -> StatsRow:
+    group_id = int(col[-11])
+    groups[group_id] = col[7]
+
+    # the last ten columns are the metrics, in StatsRow order
+    return StatsRow(to_date(col[0]), col[5], group_id, *map(int, col[-10:]))
+
+
+# an export repeats the same few hundred dates over and over
+to_date = lru_cache(maxsize=4096)(date.fromisoformat)
 
-    for col in split_response[1:]:
-        col = col.split(';')
-        if col[0] == 'Всего':
-            break
 
-        group_id = col[-11]
-        groups[group_id] = col[7].encode('UTF-8')
+async def get_selection(cookies: dict, request_url: str) -> dict:
+    params, data = parse_selection_url(request_url)
 
-        cur_obj = {
-            'date': col[0],
-            'post_name': col[5].encode('UTF-8'),
-            'group_id': group_id,
-            'followers': col[-10],
-            'reach_daily': col[-9],
-            'cost': col[-8],
-            'clicks': col[-7],
-            'new_follows': col[-6],
-            'reach_all': col[-5],
-            'reach_followers': col[-4],
-            'likes': col[-3],
-            'shares': col[-2],
-            'comments': col[-1],
-        }
+    # the same selection link is usually analyzed several times during a
+    # placement session, only the first one goes to vk
+    key = (params['ad_id'], tuple(sorted(data.items())))
+    selection = selection_cache.get(key)
+    if selection is not None:
+        return selection
 
-        obj = StatsSchema(**cur_obj)
-        objects.append(obj.dict())
+    response = (await http_client.post(params=params, cookies=cookies,
+                                       data=data)).text
 
-    stats_instances = [StatsModel(**obj) for obj in objects]
+    with metrics.timer('selection_parse'):
+        selection = parse_selection(response)
+    metrics.count('selection_groups', len(selection))
+    if selection:
+        selection_cache.set(key, selection)
 
-    return stats_instances, groups
+    return selection
 
 
-def get_selection(db: Session, request_url: str) -> dict:
+def parse_selection_url(request_url: str) -> (dict, dict):
     data = {'al': '1'}
 
     try:
@@ -78,43 +190,67 @@ def get_selection(db: Session, request_url: str) -> dict:
     except (ValueError, KeyError):
         raise
 
-    cookies, _ = get_cookies(db)
+    return params, data
 
-    response = requests.post(url=URL, params=params, cookies=cookies,
-                             headers=HEADERS, data=data).text
 
-    re_patterns = {
-        'group_name': r'exchange_comm_name\\".{,50}',
-        'group_idx': r'stats-\d+',
-        'prices': r'человек<\\/td>.{,200}<\\/b> руб.',
-        'reach_post': r'nowrap.{,200} \\/ ',
-        'reach_daily': r' \\/ .{,200}человек',
-    }
+def parse_selection(response: str) -> dict:
+    # every record is read from its own table row, a row that misses a
+    # field is dropped instead of taking the fields of the next one
+    rows = [match.group('group_idx', 'price', 'reach_post', 'reach_daily',
+                        'group_name')
+            for match in map(SELECTION_ROW.search, response.split('<tr'))
+            if match]
+    if not rows:
+        return {}
 
-    group_name = [i[21:i.find('<\/a>')] for i in re.findall(
-        re_patterns['group_name'], response)]
+    # the numbers of all rows are cleaned up in one pass, a call per
+    # number costs more than the scan
+    numbers = NOT_NUMBERS.sub('', ';'.join(
+        ';'.join(row[:4]) for row in rows)).split(';')
+    values = zip(*[map(int, numbers)] * 4)
 
-    group_idx = extract_digits(re_patterns['group_idx'], response)
-    prices = extract_digits(re_patterns['prices'], response)
-    reach_post = extract_digits(re_patterns['reach_post'], response)
-    reach_daily = extract_digits(re_patterns['reach_daily'], response)
+    return {group_idx: (row[4], price, reach_post, reach_daily)
+            for row, (group_idx, price, reach_post, reach_daily)
+            in zip(rows, values)}
 
-    return {i: (n, p, cp, cd) for i, n, p, cp, cd in zip(
-        group_idx, group_name, prices, reach_post, reach_daily)}
 
+async def get_cookies(db: AsyncSession) -> (dict, str):
+    cached = cookies_cache.get('cookies')
+    if cached is not None:
+        return cached
 
-def get_cookies(db: Session) -> (dict, str):
-    data = db.query(Cookies).first().__dict__
+    row = (await db.execute(
+        select(Cookies.remixsid, Cookies.remixnsid, Cookies.hash))).first()
     cookies = {
-        'remixsid': data.get('remixsid'),
-        'remixnsid': data.get('remixnsid'),
+        'remixsid': row.remixsid,
+        'remixnsid': row.remixnsid,
     }
-    hash_curl = data.get('hash')
+    hash_curl = row.hash
 
+    cookies_cache.set('cookies', (cookies, hash_curl))
     return cookies, hash_curl
 
 
-def get_active(db: Session, status: str) -> (list[ActiveModel], dict):
+async def renew_cookies(db: AsyncSession, expired: tuple
+                        ) -> Optional[tuple]:
+    # called once vk rejected the cached credentials, the stored ones are
+    # their version: they only replace them if another worker stored
+    # different ones in the meantime
+    cookies_cache.clear()
+    current = await get_cookies(db)
+    return current if current != expired else None
+
+
+async def get_placements(cookies: dict) -> (list[ActiveRow], dict):
+    # active and pending placements together with the groups they run in
+    (active, active_groups), (pending, pending_groups) = await asyncio.gather(
+        get_active(cookies, STATUSES['active']),
+        get_active(cookies, STATUSES['pending']))
+    return active + pending, {**active_groups, **pending_groups}
+
+
+async def get_active(cookies: dict,
+                     status: str) -> (list[ActiveRow], dict):
     params = {'act': 'overview'}
     data = {
         'act': 'overview',
@@ -123,10 +259,19 @@ def get_active(db: Session, status: str) -> (list[ActiveModel], dict):
         'status': status,
     }
 
-    cookies, _ = get_cookies(db)
+    raw = await http_client.post(params=params, cookies=cookies, data=data)
+    # one ref per status and day, a later call overwrites it
+    await archive.store(f'overview/{status}/{date.today():%Y%m%d}',
+                        raw.content)
+    response = raw.text
+    # an expired session is answered with a login redirect instead of
+    # the page, its payload has another code than 0
+    answer = AJAX_ANSWER.search(response, 0, 200)
+    if answer is None or answer['code'] != '0':
+        cookies_cache.clear()
+        raise SessionExpired
 
-    response = requests.post(url=URL, params=params, cookies=cookies,
-                             headers=HEADERS, data=data).text
+    started = time.perf_counter()
 
     group_name = [i[15:i.find('<\/a>')] for i in re.findall(
         r'"group_link\\" >.{,50}', response)]
@@ -141,21 +286,13 @@ def get_active(db: Session, status: str) -> (list[ActiveModel], dict):
     objects, groups = [], {}
 
     for i, n, pd, pr in zip(group_idx, group_name, post_date, prices):
-
         groups[i] = n
+        objects.append(ActiveRow(pd, i, pr))
 
-        cur_obj = {
-            'date': pd,
-            'group_id': i,
-            'cost': pr,
-        }
-
-        obj = ActiveSchema(**cur_obj)
-        objects.append(obj.dict())
-
-    active_instances = [ActiveModel(**obj) for obj in objects]
+    metrics.observe('active_parse', time.perf_counter() - started)
+    metrics.count('active_rows', len(objects))
 
-    return active_instances, groups
+    return objects, groups
 
 
 def handle_active(response: str) -> (list[int], list[date]):
@@ -198,7 +335,11 @@ def handle_pending(response: str) -> (list[int], list[date]):
 
 
 def extract_digits(pattern: str, response: str) -> list[int]:
-    return [int(re.sub(r'\D', '', i)) for i in re.findall(pattern, response)]
+    return [to_digits(i) for i in re.findall(pattern, response)]
+
+
+def to_digits(value: str) -> int:
+    return int(NON_DIGITS.sub('', value))
 
 
 def convert_month(month: str) -> int:
@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+from datetime import datetime
+
+import archive
+import columnar
+from db.models import (BackfillChunkModel, IngestWatermarkModel,
+                       StatsDailyModel, StatsModel)
+from db.session import SessionLocal
+from parsers import iter_stats
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from utils import write_to_db
+
+
+async def replay(db: AsyncSession, rebuild: bool = False) -> int:
+    # re-ingests archived exports through the same parser and writer as
+    # a live load, without vk or cookies
+    if rebuild:
+        await db.execute(delete(StatsDailyModel))
+        await db.execute(delete(StatsModel))
+        # what was fetched is recorded again from the replayed exports
+        await db.execute(delete(IngestWatermarkModel))
+        await db.execute(delete(BackfillChunkModel))
+
+    refs = archive.refs('get_export_stats')
+    rows = 0
+    for replayed, ref in enumerate(refs, 1):
+        groups = {}
+        lines = archive.read_lines(ref)
+        next(lines, None)
+        count = await write_to_db(db=db, stats=iter_stats(lines, groups),
+                                  groups=groups, commit=False)
+        # the ref is named after the days it covers and was written when
+        # they were fetched, later syncs don't fetch them again
+        start, end = (datetime.strptime(day, '%Y%m%d').date()
+                      for day in ref.rsplit('/', 1)[1].split('-'))
+        db.add(IngestWatermarkModel(start_date=start, end_date=end,
+                                    rows=count,
+                                    fetched_at=archive.saved_at(ref)))
+        await db.commit()
+        rows += count
+        print(f'{ref} replayed ({replayed}/{len(refs)})')
+
+    return rows
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='load stats from the raw export archive')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='drop stored stats before replaying')
+    args = parser.parse_args()
+
+    async with SessionLocal() as db:
+        rows = await replay(db, rebuild=args.rebuild)
+        await columnar.refresh(db)
+    print(f'{rows} rows replayed')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+import math
+from datetime import date
+from typing import Optional
+
+import columnar
+import metrics
+from columnar import np
+from settings import SCORE_HALF_LIFE, SCORE_PRIOR_CLICKS, SCORE_PRIOR_REACH
+
+# sort keys accepted by /analyze, cheapest first
+SORTS = {'cpc': 'expected_cpc', 'cpf': 'expected_cpf'}
+
+
+def score_selection(selection: dict) -> Optional[dict]:
+    # expected clicks of a placement are the group's recency weighted
+    # clicks per view times the reach vk quotes for it now, a group with
+    # little or no history leans on the average of all groups
+    columns = columnar.load()
+    if columns is None:
+        return None
+
+    with metrics.timer('scoring'):
+        ids = np.fromiter(selection, np.int64, len(selection))
+        price = np.fromiter((data[1] for data in selection.values()),
+                            np.float64, len(selection))
+        reach_post = np.fromiter((data[2] for data in selection.values()),
+                                 np.float64, len(selection))
+
+        groups = columns['groups']
+        if not len(groups):
+            return {}
+
+        pos = np.minimum(np.searchsorted(groups, ids), len(groups) - 1)
+        known = groups[pos] == ids
+        days = (np.datetime64(date.today())
+                - columns['weighted_at'][0]).astype(np.float64)
+        decay = np.exp2(-days / SCORE_HALF_LIFE) * known
+
+        clicks = columns['weighted_clicks'][pos] * decay
+        reach = columns['weighted_reach_all'][pos] * decay
+        follows = columns['weighted_new_follows'][pos] * decay
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prior_ctr = (columns['weighted_clicks'].sum()
+                         / columns['weighted_reach_all'].sum())
+            prior_fpc = (columns['weighted_new_follows'].sum()
+                         / columns['weighted_clicks'].sum())
+
+            ctr = ((clicks + SCORE_PRIOR_REACH * prior_ctr)
+                   / (reach + SCORE_PRIOR_REACH))
+            fpc = ((follows + SCORE_PRIOR_CLICKS * prior_fpc)
+                   / (clicks + SCORE_PRIOR_CLICKS))
+
+            expected_clicks = ctr * reach_post
+            expected_cpc = price / expected_clicks
+            expected_cpf = expected_cpc / fpc
+            # share of the estimate backed by the group's own history
+            confidence = reach / (reach + SCORE_PRIOR_REACH)
+
+        values = zip(ids.tolist(), *(
+            np.round(values, digits).tolist() for values, digits in (
+                (expected_clicks, 1), (expected_cpc, 0), (expected_cpf, 0),
+                (confidence, 2))))
+
+    return {i: {'expected_clicks': _finite(clicks),
+                'expected_cpc': _finite(cpc, int),
+                'expected_cpf': _finite(cpf, int),
+                'confidence': _finite(confidence)}
+            for i, clicks, cpc, cpf, confidence in values}
+
+
+def _finite(value: float, cast: type = float) -> Optional[float]:
+    return cast(value) if math.isfinite(value) else None
+
+
+def rank(selection: dict, scores: Optional[dict],
+         sort: Optional[str] = None) -> list[int]:
+    if not scores or sort not in SORTS:
+        return sorted(selection)
+
+    # groups that can not be scored go last
+    key = SORTS[sort]
+    return sorted(selection, key=lambda i: (
+        scores.get(i, {}).get(key) is None,
+        scores.get(i, {}).get(key) or 0, i))
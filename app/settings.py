@@ -2,11 +2,20 @@ import os
 
 from dotenv import load_dotenv
 from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemLoader
 
 load_dotenv()
 
 START_YEAR = 2015
 MAX_PLACEMENTS = 5
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', 4))
+WRITE_BATCH_SIZE = 1000
+
+# stats columns refreshed when an already stored placement is re-exported
+STATS_METRICS = (
+    'followers', 'reach_daily', 'cost', 'clicks', 'new_follows', 'reach_all',
+    'reach_followers', 'likes', 'shares', 'comments',
+)
 
 MESSAGES = {
     'success_stats_update': 'stats are up to date',
@@ -21,9 +30,34 @@ MESSAGES = {
     'failed_no_curl': 'task failed: enter curl',
     'failed_invalid_curl': 'task failed: check curl',
     'failed_date': 'task failed, check date format',
+    'failed_vk': 'task failed: vk did not respond, try again later',
 }
 
-URL = 'https://vk.com/adsmarket'
+# pointed at benchmarks.stub_server when benchmarking
+URL = os.environ.get('VK_URL', 'https://vk.com/adsmarket')
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# numpy copy of stats memory-mapped by every worker for per-group kpis,
+# an empty value (or numpy not being installed) turns it off
+STATS_CACHE_DIR = os.environ.get('STATS_CACHE_DIR', 'stats_cache')
+# the kpi trend compares the last TREND_DAYS with the whole history
+TREND_DAYS = int(os.environ.get('TREND_DAYS', 90))
+# selection scoring: history loses half its weight every SCORE_HALF_LIFE
+# days and is blended with the all-groups average as if that were
+# SCORE_PRIOR_REACH views and SCORE_PRIOR_CLICKS clicks of extra history
+SCORE_HALF_LIFE = float(os.environ.get('SCORE_HALF_LIFE', 180))
+SCORE_PRIOR_REACH = float(os.environ.get('SCORE_PRIOR_REACH', 20_000))
+SCORE_PRIOR_CLICKS = float(os.environ.get('SCORE_PRIOR_CLICKS', 20))
+
+# raw export and overview responses are kept here for offline replay,
+# an empty value turns the archive off
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archive')
+
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+# (connect, read) seconds
+HTTP_TIMEOUT = (float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5)),
+                float(os.environ.get('HTTP_READ_TIMEOUT', 60)))
 
 HEADERS = {'X-Requested-With': 'XMLHttpRequest'}
 
@@ -32,6 +66,26 @@ PARAMS = {
     'union_id': os.environ.get('UNION_ID'),
 }
 
+SELECTION_CACHE_SIZE = int(os.environ.get('SELECTION_CACHE_SIZE', 64))
+# seconds
+SELECTION_CACHE_TTL = int(os.environ.get('SELECTION_CACHE_TTL', 600))
+
+# seconds vk credentials are served from memory before being re-read,
+# picks up cookies another worker stored
+COOKIES_TTL = int(os.environ.get('COOKIES_TTL', 60))
+
+# seconds a stored active/pending snapshot is served before a live refresh
+PENDING_MAX_AGE = int(os.environ.get('PENDING_MAX_AGE', 300))
+
+# seconds an export reaching today is trusted, a refresh within that
+# time doesn't ask vk for stats again
+STATS_MAX_AGE = int(os.environ.get('STATS_MAX_AGE', 300))
+
+# seconds between background stats refreshes, 0 turns them off
+REFRESH_INTERVAL = int(os.environ.get('REFRESH_INTERVAL', 3600))
+# print a json line with the stage timings of every request
+TIMING_LOG = os.environ.get('TIMING_LOG') == '1'
+
 STATUSES = {
     'pending': '1',
     'active': '3',
@@ -43,6 +97,23 @@ data = {
     'grouping_exchange': '4',
 }
 
+# templates are compiled once at startup, set TEMPLATES_AUTO_RELOAD=1 to
+# pick up edits without restarting
+TEMPLATES_AUTO_RELOAD = os.environ.get('TEMPLATES_AUTO_RELOAD') == '1'
+# pages with more table rows than this are sent while being rendered
+RENDER_STREAM_ROWS = int(os.environ.get('RENDER_STREAM_ROWS', 500))
+# template output pieces joined per streamed chunk, one per piece would
+# cost a send (and a threadpool hop) for every few bytes of html
+RENDER_BUFFER = 1000
+
 templates = Jinja2Templates(directory="templates")
+templates.env.auto_reload = TEMPLATES_AUTO_RELOAD
+# renders pages while their data is still being read
+stream_templates = Environment(loader=FileSystemLoader("templates"),
+                               autoescape=True, enable_async=True,
+                               auto_reload=TEMPLATES_AUTO_RELOAD)
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+# alembic keeps using the sync driver from DATABASE_URL
+ASYNC_DATABASE_URL = (DATABASE_URL or '').replace(
+    'postgresql://', 'postgresql+asyncpg://', 1)
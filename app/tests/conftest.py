@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the app imports its modules from the 'app' folder, the engine is
+# created at import time but never connects in these tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/mp')
@@ -0,0 +1,23 @@
+from benchmarks.fixtures import make_selection
+from parsers import parse_selection
+
+
+def test_parse_selection_reads_every_row():
+    selection = parse_selection(make_selection(3, ids=[11, 22, 33]))
+    assert {i: name for i, (name, *_) in selection.items()} == {
+        11: 'Сообщество 0', 22: 'Сообщество 1', 33: 'Сообщество 2'}
+    assert all(isinstance(value, int) for _, *values in selection.values()
+               for value in values)
+
+
+def test_parse_selection_drops_a_row_missing_a_field():
+    # the first row lost its name, the others keep their own
+    response = make_selection(3, ids=[11, 22, 33]).replace(
+        'class=\\"exchange_comm_name\\">Сообщество 0', '>Сообщество 0', 1)
+    selection = parse_selection(response)
+    assert {i: name for i, (name, *_) in selection.items()} == {
+        22: 'Сообщество 1', 33: 'Сообщество 2'}
+
+
+def test_parse_selection_without_rows():
+    assert parse_selection('<!--{"payload":[0,[""]]}') == {}
@@ -0,0 +1,77 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+import watermarks
+from watermarks import covered, find_gaps, plan
+
+TODAY = date(2026, 10, 18)
+NOW = datetime(2026, 10, 18, 12)
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(watermarks, 'START_YEAR', 2026)
+    monkeypatch.setattr(watermarks, 'BACKFILL_WORKERS', 2)
+    monkeypatch.setattr(watermarks, 'STATS_MAX_AGE', 300)
+
+
+def fetched(start, end, at=NOW):
+    return start, end, at
+
+
+def test_find_gaps_without_ranges():
+    assert find_gaps([], date(2026, 1, 1), TODAY) == [
+        (date(2026, 1, 1), TODAY)]
+
+
+def test_find_gaps_between_overlapping_ranges():
+    ranges = [fetched(date(2026, 1, 1), date(2026, 3, 31)),
+              fetched(date(2026, 3, 1), date(2026, 4, 10)),
+              fetched(date(2026, 6, 1), date(2026, 6, 30)),
+              fetched(date(2026, 9, 1), date(2026, 9, 30))]
+    assert find_gaps(ranges, date(2026, 1, 1), date(2026, 8, 31)) == [
+        (date(2026, 4, 11), date(2026, 5, 31)),
+        (date(2026, 7, 1), date(2026, 8, 31))]
+
+
+def test_covered_clamps_future_quarters_to_their_fetch():
+    loaded = datetime(2026, 10, 5, 9)
+    rows = [(date(2026, 10, 1), date(2026, 12, 31), loaded),
+            (date(2026, 7, 1), date(2026, 9, 30), loaded)]
+    assert covered(rows) == [
+        (date(2026, 7, 1), date(2026, 9, 30), loaded),
+        (date(2026, 10, 1), date(2026, 10, 5), loaded)]
+
+
+def test_plan_skips_a_recent_export_that_reached_today():
+    ranges = [fetched(date(2026, 1, 1), TODAY, NOW - timedelta(minutes=1))]
+    assert plan(ranges, TODAY, NOW) == ([], [])
+
+
+def test_plan_refetches_a_stale_last_day():
+    ranges = [fetched(date(2026, 1, 1), TODAY, NOW - timedelta(hours=1))]
+    assert plan(ranges, TODAY, NOW) == ([(TODAY, TODAY)], [])
+
+
+def test_plan_fetches_from_a_clamped_backfill_quarter():
+    # a load on the 5th stored the current quarter, the days after it
+    # are still missing although the quarter ends in december
+    ranges = covered([
+        (date(2026, 1, 1), date(2026, 9, 30), datetime(2026, 10, 5)),
+        (date(2026, 10, 1), date(2026, 12, 31), datetime(2026, 10, 5))])
+    assert plan(ranges, TODAY, NOW) == ([(date(2026, 10, 5), TODAY)], [])
+
+
+def test_plan_leaves_gaps_to_the_background_run():
+    ranges = [fetched(date(2026, 7, 1), TODAY, NOW)]
+    assert plan(ranges, TODAY, NOW) == (
+        [], [(date(2026, 4, 1), date(2026, 6, 30)),
+             (date(2026, 1, 1), date(2026, 3, 31))])
+
+
+def test_plan_fills_gaps_newest_first_a_few_per_run():
+    ranges = [fetched(date(2026, 10, 1), TODAY, NOW)]
+    todo, gaps = plan(ranges, TODAY, NOW, fill_gaps=True)
+    assert todo == [(date(2026, 7, 1), date(2026, 9, 30)),
+                    (date(2026, 4, 1), date(2026, 6, 30))]
+    assert gaps == [(date(2026, 1, 1), date(2026, 3, 31))]
@@ -1,28 +1,250 @@
 import re
-from typing import Optional
+import time
+from datetime import date, timedelta
+from itertools import islice
+from typing import (AsyncIterable, AsyncIterator, Iterable, Iterator, Optional,
+                    Union)
 
-from db.models import ActiveModel, GroupModel, StatsModel
-from db.schemas import GroupSchema
+import columnar
+import metrics
+from db.models import (ActiveModel, ActiveSnapshotModel, GroupModel,
+                       PlacementMarkModel, StatsDailyModel, StatsModel)
+from db.schemas import ActiveRow, StatsRow
 from fastapi import Request
-from settings import MAX_PLACEMENTS, templates
-from sqlalchemy.orm import Session
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from scoring import rank, score_selection
+from settings import (MAX_PLACEMENTS, PENDING_MAX_AGE, RENDER_BUFFER,
+                      RENDER_STREAM_ROWS, STATS_METRICS, WRITE_BATCH_SIZE,
+                      stream_templates, templates)
+from sqlalchemy import (ARRAY, Integer, bindparam, column, delete, func, or_,
+                        select, table, text, true, update)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 
-def get_group_instances(groups: dict) -> list[GroupModel]:
-    groups = [GroupSchema(id=i, name=n).dict() for i, n in groups.items()]
-    group_instances = [GroupModel(**group) for group in groups]
-    return group_instances
+# advisory lock keys of the stored active/pending snapshot, one for
+# replacing it and one for /pending requests that ask vk for a new one
+ACTIVE_LOCK = 20230519
+PENDING_LOCK = 20230521
 
+# per connection staging table parsed rows are copied into
+STATS_STAGE = table('stats_stage',
+                    *(column(name) for name in StatsRow._fields))
 
-def write_to_db(db: Session, stats: list[StatsModel], groups: list[GroupModel],
-                active: list[ActiveModel] = None) -> None:
-    for group in groups:
-        db.merge(group)
-    db.flush()
-    db.add_all(stats)
+
+def get_group_rows(groups: dict) -> list[dict]:
+    # the same order in every writer, concurrent upserts of overlapping
+    # groups then wait on each other instead of deadlocking
+    return [{'id': i, 'name': n} for i, n in sorted(groups.items())]
+
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+async def upsert_groups(db: AsyncSession, groups: dict) -> None:
+    for batch in batched(get_group_rows(groups), WRITE_BATCH_SIZE):
+        stmt = insert(GroupModel).values(batch)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[GroupModel.id],
+            set_={'name': stmt.excluded.name}))
+
+
+async def copy_records(db: AsyncSession, table_name: str,
+                       columns: Iterable[str],
+                       records: Union[Iterable[tuple], AsyncIterable[tuple]]
+                       ) -> None:
+    # COPY runs on the session's own connection, inside its transaction
+    connection = await (await db.connection()).get_raw_connection()
+    await connection.driver_connection.copy_records_to_table(
+        table_name, records=records, columns=list(columns))
+
+
+async def stage_stats(db: AsyncSession, first: StatsRow,
+                      stats: AsyncIterator[StatsRow]) -> (int, set[date]):
+    # emptied by every commit, so a pooled connection reuses it as is
+    await db.execute(text(
+        'CREATE TEMP TABLE IF NOT EXISTS stats_stage ON COMMIT DELETE ROWS '
+        f'AS SELECT {", ".join(StatsRow._fields)} FROM stats WITH NO DATA'))
+
+    rows, dates = 1, {first.date}
+
+    async def track() -> AsyncIterator[StatsRow]:
+        nonlocal rows
+        yield first
+        async for row in stats:
+            rows += 1
+            dates.add(row.date)
+            yield row
+
+    await copy_records(db, STATS_STAGE.name, StatsRow._fields, track())
+
+    return rows, dates
+
+
+async def iter_async(items: Union[Iterable, AsyncIterable]
+                     ) -> AsyncIterator:
+    if isinstance(items, AsyncIterable):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def ensure_stats_partitions(db: AsyncSession,
+                                  dates: Iterable[date]) -> None:
+    # stats is partitioned by year and refuses a row whose year has no
+    # partition yet
+    missing = await db.scalars(text(
+        'SELECT year FROM unnest(CAST(:years AS integer[])) AS year '
+        "WHERE to_regclass('stats_' || year) IS NULL"),
+        {'years': sorted({day.year for day in dates})})
+    for year in missing:
+        await db.execute(text(
+            f'CREATE TABLE IF NOT EXISTS stats_{year} PARTITION OF stats '
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"))
+
+
+async def upsert_stats(db: AsyncSession) -> None:
+    # a key repeated within one write would make the upsert hit the same
+    # row twice, which postgres refuses
+    staged = select(*STATS_STAGE.c).distinct(
+        STATS_STAGE.c.date, STATS_STAGE.c.group_id, STATS_STAGE.c.post_name)
+    stmt = insert(StatsModel).from_select(StatsRow._fields, staged)
+    columns = [getattr(StatsModel, name) for name in STATS_METRICS]
+    # rows that come back unchanged are left alone instead of rewritten
+    await db.execute(stmt.on_conflict_do_update(
+        constraint='uq_stats_date_group_id_post_name',
+        set_={name: stmt.excluded[name] for name in STATS_METRICS},
+        where=or_(*(column.is_distinct_from(stmt.excluded[column.name])
+                    for column in columns))))
+
+
+async def refresh_daily(db: AsyncSession, dates: list[date]) -> None:
+    daily = select(
+        StatsModel.date, StatsModel.post_name,
+        func.sum(StatsModel.cost), func.sum(StatsModel.clicks),
+        func.sum(StatsModel.reach_all)
+    ).where(StatsModel.date.in_(dates)).group_by(
+        StatsModel.date, StatsModel.post_name)
+
+    stmt = insert(StatsDailyModel).from_select(
+        ['date', 'post_name', 'cost', 'clicks', 'reach_all'], daily)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[StatsDailyModel.date, StatsDailyModel.post_name],
+        set_={name: stmt.excluded[name]
+              for name in ('cost', 'clicks', 'reach_all')}))
+
+
+async def write_to_db(db: AsyncSession,
+                      stats: Union[Iterable[StatsRow],
+                                   AsyncIterable[StatsRow]],
+                      groups: dict,
+                      active: Optional[list[ActiveRow]] = None,
+                      commit: bool = True) -> int:
+    stats = iter_async(stats)
+    rows, dates = 0, set()
+
+    # stats may be a stream that keeps filling groups, it is copied into
+    # the staging table first and the groups it introduced are upserted
+    # before the rows that reference them (foreign key). An export checks
+    # its session on the first row, before anything is written
+    try:
+        first = await stats.__anext__()
+    except StopAsyncIteration:
+        first = None
+    if first is not None:
+        with metrics.timer('db_copy_stats'):
+            rows, dates = await stage_stats(db, first, stats)
+    with metrics.timer('db_upsert_groups'):
+        await upsert_groups(db, groups)
+    if rows:
+        with metrics.timer('db_upsert_stats'):
+            await ensure_stats_partitions(db, dates)
+            await upsert_stats(db)
+    # the daily rollup is rebuilt for the days that were just written
+    with metrics.timer('db_refresh_daily'):
+        for batch in batched(dates, WRITE_BATCH_SIZE):
+            await refresh_daily(db, batch)
+    if active is not None:
+        with metrics.timer('db_insert_active'):
+            await replace_active(db, active)
+    if commit:
+        with metrics.timer('db_commit'):
+            await db.commit()
+    metrics.count('db_rows_written', rows)
+
+    return rows
+
+
+async def lock(db: AsyncSession, key: int) -> None:
+    await db.execute(select(func.pg_advisory_xact_lock(key)))
+
+
+async def replace_active(db: AsyncSession, active: list[ActiveRow]) -> None:
+    # one transaction at a time, delete + insert would otherwise keep the
+    # rows of another. Taken after the groups were upserted, so every
+    # writer locks groups before the snapshot. The time is stored apart
+    # from the rows, an account without any placement is fresh too
+    await lock(db, ACTIVE_LOCK)
+    await db.execute(delete(ActiveModel))
+    await db.execute(delete(ActiveSnapshotModel))
+    await db.execute(insert(ActiveSnapshotModel).values(fetched_at=func.now()))
     if active:
-        db.add_all(active)
-    db.commit()
+        await copy_records(db, ActiveModel.__tablename__, ActiveRow._fields,
+                           active)
+
+
+async def is_active_fresh(db: AsyncSession) -> bool:
+    fetched_at = func.max(ActiveSnapshotModel.fetched_at)
+    return bool(await db.scalar(select(
+        fetched_at > func.now() - timedelta(seconds=PENDING_MAX_AGE))))
+
+
+async def get_pending(db: AsyncSession) -> dict:
+    data = await db.execute(
+        select(ActiveModel.date, func.sum(ActiveModel.cost)).group_by(
+            ActiveModel.date).order_by(ActiveModel.date))
+
+    return {dt.strftime('%d %B %y'): cost for dt, cost in data}
+
+
+async def get_marks(db: AsyncSession, group_ids: Iterable[int]
+                    ) -> (set[int], set[int]):
+    data = await db.scalars(select(PlacementMarkModel).where(
+        PlacementMarkModel.group_id.in_(group_ids)))
+
+    cache, skipped = set(), set()
+    for mark in data:
+        if mark.cached:
+            cache.add(mark.group_id)
+        if mark.skipped:
+            skipped.add(mark.group_id)
+
+    return cache, skipped
+
+
+async def mark_cached(db: AsyncSession, group_ids: Iterable[int]) -> None:
+    # sorted like get_group_rows, overlapping selections analyzed at once
+    # wait on each other instead of deadlocking
+    for batch in batched(sorted(group_ids), WRITE_BATCH_SIZE):
+        stmt = insert(PlacementMarkModel).values(
+            [{'group_id': i, 'cached': True, 'skipped': False}
+             for i in batch])
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[PlacementMarkModel.group_id],
+            set_={'cached': True}))
+    await db.commit()
+
+
+async def skip_cached(db: AsyncSession) -> None:
+    await db.execute(update(PlacementMarkModel).where(
+        PlacementMarkModel.cached).values(cached=False, skipped=True))
+    await db.commit()
 
 
 def extract_cookies(pattern: str, curl: str) -> str:
@@ -33,38 +255,110 @@ def extract_cookies(pattern: str, curl: str) -> str:
     return match
 
 
-def get_context(db: Session, selection: dict) -> dict:
-    data = db.query(StatsModel, GroupModel).join(GroupModel).order_by(
-        StatsModel.group_id).order_by(StatsModel.date.desc()).where(
-            StatsModel.group_id.in_(selection.keys()))
-
-    context = {}
-    for stats, group in data:
-        if stats.group_id not in context:
-            context[stats.group_id] = {
-                'group_name': group.name,
-                'cost': selection[stats.group_id][1],
-                'reach': f'{selection[stats.group_id][2] // 1000} / '
-                         f'{selection[stats.group_id][3] // 1000}',
-                'data': [],
-            }
-
-        if len(context[stats.group_id]['data']) < MAX_PLACEMENTS:
-            cl_rub = stats.cost // stats.clicks if stats.clicks else stats.cost
-            reach_rub = (stats.cost * 1000 // stats.reach_all
-                         if stats.reach_all else stats.cost)
-            item = {'click_rub': cl_rub,
-                    'date': stats.date.strftime('%d %B %y'),
-                    'post_name': stats.post_name,
-                    'cost_prev': stats.cost,
-                    'new_follows': stats.new_follows,
-                    'clicks': stats.clicks,
-                    'reach': stats.reach_all,
-                    'reach_rub': reach_rub}
-
-            context[stats.group_id]['data'].append(item)
-
-    return context
+def group_context(data: tuple, group_name: Optional[str] = None,
+                  items: Optional[list] = None, kpi: Optional[dict] = None,
+                  score: Optional[dict] = None) -> dict:
+    return {
+        'group_name': group_name or data[0],
+        'cost': data[1],
+        'reach': f'{data[2] // 1000} / {data[3] // 1000}',
+        'data': items,
+        'kpi': kpi,
+        'score': score,
+    }
+
+
+def stats_item(stats: StatsModel) -> dict:
+    cl_rub = stats.cost // stats.clicks if stats.clicks else stats.cost
+    reach_rub = (stats.cost * 1000 // stats.reach_all
+                 if stats.reach_all else stats.cost)
+    return {'click_rub': cl_rub,
+            'date': stats.date.strftime('%d %B %y'),
+            'post_name': stats.post_name,
+            'cost_prev': stats.cost,
+            'new_follows': stats.new_follows,
+            'clicks': stats.clicks,
+            'reach': stats.reach_all,
+            'reach_rub': reach_rub}
+
+
+async def iter_context(db: AsyncSession, selection: dict,
+                       sort: Optional[str] = None
+                       ) -> AsyncIterator[tuple[int, dict]]:
+    # kpis over the whole history come from the columnar cache when it
+    # is on, in one pass for the selection, and so do the scores
+    kpis = columnar.group_kpis(selection) or {}
+    scores = score_selection(selection) or {}
+    order = rank(selection, scores, sort)
+
+    # the latest MAX_PLACEMENTS rows of every group are picked by the
+    # (group_id, date desc) index instead of loading the whole history
+    latest = select(StatsModel).where(
+        StatsModel.group_id == GroupModel.id).order_by(
+            StatsModel.date.desc()).limit(MAX_PLACEMENTS).lateral()
+    stats_alias = aliased(StatsModel, latest)
+
+    # rows come back in the order of the ranking, by id unless sorted
+    position = func.array_position(
+        bindparam('order', order, type_=ARRAY(Integer)), GroupModel.id)
+    data = await db.stream(
+        select(stats_alias, GroupModel).select_from(GroupModel).join(
+            latest, true()).where(
+                GroupModel.id.in_(selection.keys())).order_by(
+                    position, stats_alias.date.desc()))
+
+    # groups come out as soon as their last row is read, the ones
+    # without history are slotted in between
+    group_ids = iter(order)
+    current_id, current = None, None
+
+    async for stats, group in data:
+        if stats.group_id != current_id:
+            if current is not None:
+                yield current_id, current
+            for group_id in group_ids:
+                if group_id == stats.group_id:
+                    break
+                yield group_id, group_context(
+                    selection[group_id], score=scores.get(group_id))
+            current_id = stats.group_id
+            current = group_context(selection[current_id], group.name, [],
+                                    kpis.get(current_id),
+                                    scores.get(current_id))
+
+        current['data'].append(stats_item(stats))
+
+    if current is not None:
+        yield current_id, current
+
+    for group_id in group_ids:
+        yield group_id, group_context(selection[group_id],
+                                      score=scores.get(group_id))
+
+
+async def get_context(db: AsyncSession, selection: dict,
+                      sort: Optional[str] = None) -> dict:
+    with metrics.timer('db_context'):
+        return {group_id: group_data async for group_id, group_data
+                in iter_context(db, selection, sort)}
+
+
+async def get_active_ids(db: AsyncSession,
+                         group_ids: Iterable[int]) -> list[int]:
+    return (await db.scalars(select(ActiveModel.group_id).where(
+        ActiveModel.group_id.in_(group_ids)))).all()
+
+
+def load_templates() -> None:
+    for name in templates.env.list_templates():
+        templates.get_template(name)
+        stream_templates.get_template(name)
+
+
+def timed_render(name: str, chunks: Iterable[str]) -> Iterator[str]:
+    started = time.perf_counter()
+    yield from chunks
+    metrics.observe(f'render_{name}', time.perf_counter() - started)
 
 
 def render_template(request: Request,
@@ -74,9 +368,44 @@ def render_template(request: Request,
                     performance: Optional[list] = None,
                     cache: Optional[list[int]] = None,
                     skipped: Optional[list[int]] = None,
-                    active: Optional[dict] = None) -> None:
-    return templates.TemplateResponse(
-        'index.html',
-        {'request': request, 'context': context, 'pending': pending,
-         'performance': performance, 'active': active, 'message': message,
-         'cache': cache, 'skipped': skipped})
+                    active: Optional[dict] = None,
+                    fragment: Optional[str] = None) -> Response:
+    # a fragment renders just one block of the page, e.g. 'pending'
+    name = fragment or 'index'
+    template = templates.get_template(
+        f'fragments/{fragment}.html' if fragment else 'index.html')
+    values = {'request': request, 'context': context, 'pending': pending,
+              'performance': performance, 'active': active,
+              'message': message, 'cache': cache, 'skipped': skipped}
+
+    rows = len(context or ()) + len(pending or ()) + len(performance or ())
+    if rows > RENDER_STREAM_ROWS:
+        stream = template.stream(values)
+        stream.enable_buffering(RENDER_BUFFER)
+        return StreamingResponse(timed_render(name, stream),
+                                 media_type='text/html')
+
+    started = time.perf_counter()
+    content = template.render(values)
+    metrics.observe(f'render_{name}', time.perf_counter() - started)
+
+    return HTMLResponse(content)
+
+
+async def stream_template(request: Request,
+                          context: AsyncIterator[tuple[int, dict]],
+                          cache: set[int], skipped: set[int],
+                          active: list[int]) -> AsyncIterator[str]:
+    template = stream_templates.get_template('index.html')
+    started = time.perf_counter()
+    buffer = []
+    async for chunk in template.generate_async(
+            request=request, message='', context=context, cache=cache,
+            skipped=skipped, active=active):
+        buffer.append(chunk)
+        if len(buffer) >= RENDER_BUFFER:
+            yield ''.join(buffer)
+            buffer = []
+    yield ''.join(buffer)
+    # includes the db reads interleaved with rendering
+    metrics.observe('render_analysis_stream', time.perf_counter() - started)
@@ -0,0 +1,93 @@
+from datetime import date, datetime, time, timedelta
+from typing import Iterable
+
+from backfill import get_chunks
+from db.models import BackfillChunkModel, IngestWatermarkModel, StatsModel
+from settings import BACKFILL_WORKERS, START_YEAR, STATS_MAX_AGE
+from sqlalchemy import func, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+DAY = timedelta(days=1)
+
+
+async def fetched_ranges(db: AsyncSession
+                         ) -> list[tuple[date, date, datetime]]:
+    # exports stored by syncs and quarters stored by /load_stats
+    rows = await db.execute(union_all(
+        select(IngestWatermarkModel.start_date, IngestWatermarkModel.end_date,
+               IngestWatermarkModel.fetched_at),
+        select(BackfillChunkModel.start_date, BackfillChunkModel.end_date,
+               BackfillChunkModel.loaded_at)))
+    return covered(rows)
+
+
+def covered(rows: Iterable[tuple[date, date, datetime]]
+            ) -> list[tuple[date, date, datetime]]:
+    # a range fetched before it was over only covers the days up to the
+    # fetch
+    return sorted((start, min(end, fetched_at.date()), fetched_at)
+                  for start, end, fetched_at in rows)
+
+
+def find_gaps(ranges: list[tuple[date, date, datetime]], start: date,
+              end: date) -> list[tuple[date, date]]:
+    gaps, cursor = [], start
+    for first, last, _ in ranges:
+        if first > end:
+            break
+        if first > cursor:
+            gaps.append((cursor, first - DAY))
+        cursor = max(cursor, last + DAY)
+    if cursor <= end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def split_quarters(start: date, end: date) -> list[tuple[date, date]]:
+    return [(max(start, first), min(end, last))
+            for first, last in get_chunks(start.year, end.year)
+            if first <= end and last >= start]
+
+
+async def plan_sync(db: AsyncSession, last_date: date,
+                    fill_gaps: bool = False
+                    ) -> (list[tuple[date, date]], list[tuple[date, date]]):
+    ranges = await fetched_ranges(db)
+
+    # stats stored without any watermark count as fetched up to their
+    # last day, like the migration that added watermarks did, the seed
+    # is committed with the run
+    if not ranges:
+        first_date = await db.scalar(select(func.min(StatsModel.date)))
+        seed = IngestWatermarkModel(
+            start_date=first_date, end_date=last_date,
+            fetched_at=datetime.combine(last_date, time()))
+        db.add(seed)
+        ranges = [(seed.start_date, seed.end_date, seed.fetched_at)]
+
+    return plan(ranges, date.today(), datetime.now(), fill_gaps)
+
+
+def plan(ranges: list[tuple[date, date, datetime]], today: date,
+         now: datetime, fill_gaps: bool = False
+         ) -> (list[tuple[date, date]], list[tuple[date, date]]):
+    # returns the ranges to export now and the gaps left for later runs
+    latest = max(ranges, key=lambda item: item[1:])
+
+    # the last fetched day was not over yet, it is fetched again unless
+    # that fetch reached today and is recent enough
+    todo = []
+    if (latest[1] < today
+            or now - latest[2] > timedelta(seconds=STATS_MAX_AGE)):
+        todo.append((latest[1], today))
+
+    # days no run has fetched, e.g. quarters of an interrupted load,
+    # newest first and a few quarters per background run, a sync someone
+    # waits for only fetches the tail
+    gaps = [chunk for gap in find_gaps(ranges, date(START_YEAR, 1, 1),
+                                       latest[1] - DAY)
+            for chunk in split_quarters(*gap)][::-1]
+    if not fill_gaps:
+        return todo, gaps
+
+    return todo + gaps[:BACKFILL_WORKERS], gaps[BACKFILL_WORKERS:]